@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for style_transfer.py. The microbenchmarks of host-side hot paths do not require
+Caffe; the end-to-end benchmarks do."""
+
+# pylint: disable=invalid-name
+
+import argparse
+from collections import OrderedDict
+import sys
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+from six import print_
+
+import style_transfer as st
+from style_transfer import timer
+
+
+def vgg19_model():
+    """Returns a placeholder CaffeModel with the layer shapes of VGG-19 for a 224x224 input."""
+    shapes = OrderedDict()
+    size = 224
+    for block, convs in enumerate((2, 2, 4, 4, 4)):
+        channels = min(64 * 2**block, 512)
+        for i in range(convs):
+            shapes['conv%d_%d' % (block+1, i+1)] = (channels, size, size)
+        size //= 2
+        shapes['pool%d' % (block+1)] = (channels, size, size)
+    return st.CaffeModel('vgg19.prototxt', 'vgg19.caffemodel', shapes=shapes, placeholder=True)
+
+
+def time_it(fn, repeat):
+    """Returns the best of repeat timings of fn(), in seconds."""
+    best = np.inf
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        best = min(best, timer() - start)
+    return best
+
+
+def peak_alloc(fn):
+    """Returns the peak memory allocated by numpy during fn(), in MB."""
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def bench_jitter(args):
+    """Compares per-step jitter cost: physically rolling the image, feature maps, layer masks, and
+    optimizer state forward and back versus reading and writing tiles at a virtual offset."""
+    model = vgg19_model()
+    content_layer = 'conv4_2'
+    jitter_scale, channels = model.layer_info(content_layer)
+    print_('size,physical_ms,virtual_ms,saved_ms')
+    for size in args.sizes:
+        img = np.float32(np.random.uniform(-127, 127, (3, size, size)))
+        grad = np.zeros_like(img)
+        feat_size = -(-size // jitter_scale)
+        features = {content_layer: np.zeros((channels, feat_size, feat_size), np.float32)}
+        masks = model.make_layer_masks(np.ones((size, size), np.float32))
+        style_masks = model.make_layer_masks(np.ones((size, size), np.float32))
+        optimizer = st.AdamOptimizer(img)
+        img_size = np.array(img.shape[-2:])
+        xy = np.int32(np.random.uniform(-0.5, 0.5, size=2) * img_size) // jitter_scale
+        roll = xy * jitter_scale
+
+        def roll_all(roll):
+            for feats in (features, masks, style_masks):
+                for layer, feat in feats.items():
+                    scale, _ = model.layer_info(layer)
+                    feat[:] = st.roll2(feat, roll // scale)
+            img[:] = st.roll2(img, roll)
+            optimizer.roll(roll)
+
+        def physical():
+            roll_all(roll)
+            for start, end in st.tile_bounds(img_size, args.tile_size):
+                tile = img[:, start[0]:end[0], start[1]:end[1]].copy()
+                grad[:, start[0]:end[0], start[1]:end[1]] = tile
+            roll_all(-roll)
+
+        def virtual():
+            for start, end in st.tile_bounds(img_size, args.tile_size):
+                index = st.roll2_index(img.shape, roll, start, end)
+                grad[index] = img[index]
+
+        t_physical = time_it(physical, args.repeat) * 1000
+        t_virtual = time_it(virtual, args.repeat) * 1000
+        print_('%d,%.2f,%.2f,%.2f' % (size, t_physical, t_virtual, t_physical - t_virtual),
+               flush=True)
+
+
+def reference_regularizers(img, roll, mean, tv_weight, tv_power, p_weight, p_power):
+    """The regularizer loss and gradient as computed before Regularizers, with full-size
+    temporaries."""
+    tv_loss, tv_grad = st.tv_norm(img / 255, beta=tv_power)
+    loss = tv_weight * tv_loss
+    h, w = tv_grad.shape[-2:]
+    tv_mask = np.ones_like(tv_grad)
+    tv_mask[:, (np.array([0, 1, h-2, h-1]) - roll[1]) % h, :] = 5
+    tv_mask[:, :, (np.array([0, 1, w-2, w-1]) - roll[0]) % w] = 5
+    grad = tv_weight * tv_grad * tv_mask
+    img_scaled = abs((img + mean - 127.5) / 127.5)
+    img_pow = img_scaled**(p_power-1)
+    loss += p_weight * np.sum(img_pow * img_scaled)
+    grad += p_weight * p_power * np.sign(img) * img_pow
+    return loss, grad
+
+
+def bench_regularizers(args):
+    """Compares the TV norm and p-norm regularizers computed with full-size temporaries against
+    the in-place Regularizers workspaces, and checks that their results match."""
+    mean = np.float32((103.939, 116.779, 123.68)).reshape((3, 1, 1))
+    print_('size,beta,reference_ms,inplace_ms,reference_peak_mb,inplace_peak_mb,loss_rel_err,'
+           'grad_max_err')
+    for size in args.sizes:
+        img = np.float32(np.random.uniform(-127, 127, (3, size, size)))
+        roll = np.int32(np.random.uniform(-0.5, 0.5, size=2) * size)
+        regularizers = st.Regularizers(img.shape, mean, threads=args.threads)
+        for beta in args.betas:
+            params = (roll, 1.0, beta, 0.05, 6)
+            ref_loss, ref_grad = reference_regularizers(img, roll, mean, *params[1:])
+            loss, grad = regularizers(img, *params)
+            loss_err = abs(loss - ref_loss) / abs(ref_loss)
+            grad_err = np.max(abs(grad - ref_grad)) / np.max(abs(ref_grad))
+            if loss_err > 1e-4 or grad_err > 1e-4:
+                raise AssertionError('Regularizers do not match the reference at size %d, beta %g'
+                                     % (size, beta))
+            t_ref = time_it(lambda: reference_regularizers(img, roll, mean, *params[1:]),
+                            args.repeat) * 1000
+            t_inplace = time_it(lambda: regularizers(img, *params), args.repeat) * 1000
+            mb_ref = peak_alloc(lambda: reference_regularizers(img, roll, mean, *params[1:]))
+            mb_inplace = peak_alloc(lambda: regularizers(img, *params))
+            print_('%d,%g,%.2f,%.2f,%.1f,%.1f,%.2e,%.2e' % (
+                size, beta, t_ref, t_inplace, mb_ref, mb_inplace, loss_err, grad_err), flush=True)
+
+
+def reference_adam_update(opt, grad):
+    """The AdamOptimizer update as computed before it was made in-place, with full-size
+    temporaries."""
+    opt.step += 1
+    opt.g1 *= opt.b1
+    st.axpy(1 - opt.b1, grad, opt.g1)
+    opt.g2 *= opt.b2
+    st.axpy(1 - opt.b2, grad**2, opt.g2)
+    step_size = opt.step_size * np.sqrt(1-opt.b2**opt.step) / (1-opt.b1**opt.step)
+    step = opt.g1 / (np.sqrt(opt.g2) + st.EPS)
+    st.axpy(-step_size, step, opt.params)
+    opt.p1 *= opt.bp1
+    st.axpy(1 - opt.bp1, opt.params, opt.p1)
+    return st.roll2(opt.p1, -opt.xy) / (1-opt.bp1**opt.step)
+
+
+def bench_adam(args):
+    """Compares the AdamOptimizer update computed with full-size temporaries against the in-place
+    update, and checks that their results match."""
+    print_('size,reference_ms,inplace_ms,reference_peak_mb,inplace_peak_mb,max_err')
+    for size in args.sizes:
+        img = np.float32(np.random.uniform(-127, 127, (3, size, size)))
+        grads = [np.float32(np.random.normal(size=img.shape)) for _ in range(3)]
+        ref = st.AdamOptimizer(img.copy(), step_size=15, bp1=0.95)
+        opt = st.AdamOptimizer(img.copy(), step_size=15, bp1=0.95)
+        for grad in grads:
+            ref_avg = reference_adam_update(ref, grad)
+            avg, _ = opt.update(lambda _, grad=grad: (0, grad))
+            err = np.max(abs(avg - ref_avg)) / np.max(abs(ref_avg))
+            if err > 1e-5:
+                raise AssertionError('In-place update does not match the reference at size %d'
+                                     % size)
+        t_ref = time_it(lambda: reference_adam_update(ref, grads[0]), args.repeat) * 1000
+        t_inplace = time_it(lambda: opt.update(lambda _: (0, grads[0])), args.repeat) * 1000
+        mb_ref = peak_alloc(lambda: reference_adam_update(ref, grads[0]))
+        mb_inplace = peak_alloc(lambda: opt.update(lambda _: (0, grads[0])))
+        print_('%d,%.2f,%.2f,%.1f,%.1f,%.2e' % (size, t_ref, t_inplace, mb_ref, mb_inplace, err),
+               flush=True)
+
+
+class LossTrace:
+    """A transfer_multiscale() callback which records the wall time and loss after each step."""
+    def __init__(self):
+        self.start = timer()
+        self.trace = []
+
+    def __call__(self, loss, **_):
+        self.trace.append((timer() - self.start, loss))
+
+    def set_steps(self, steps):
+        """Called with the total number of steps; unused."""
+        pass
+
+
+def bench_optimizers(args):
+    """Runs style transfer end-to-end with each optimizer from the same seed and prints the loss
+    after each step against the wall time since the start of the run. Requires Caffe."""
+    print_('optimizer,step,seconds,loss')
+    results = []
+    pool = None
+    for name in args.optimizers:
+        st.ARGS = st.make_parser().parse_args(
+            [args.content_image, args.style_image, '--optimizer', name, '--seed', str(args.seed),
+             '--no-browser'] + args.transfer_args)
+        model = st.load_model()
+        transfer = st.StyleTransfer(model)
+        transfer.pool = pool
+        transfer.start_pool()
+        pool = transfer.pool
+        trace = LossTrace()
+        np.random.seed(args.seed)
+        transfer.transfer_multiscale(
+            [Image.open(args.content_image).convert('RGB')],
+            [Image.open(args.style_image).convert('RGB')], None, None, [], [], callback=trace)
+        results.append((name, trace.trace))
+    for name, trace in results:
+        for step, (seconds, loss) in enumerate(trace, 1):
+            print_('%s,%d,%.3f,%g' % (name, step, seconds, loss))
+
+
+class TileTimer:
+    """Wraps CaffeModel.eval_sc_grad(), recording the number of tiles evaluated and the time
+    spent."""
+    def __init__(self, model):
+        self.model = model
+        self.eval_sc_grad = model.eval_sc_grad
+        self.tiles = 0
+        self.seconds = 0
+
+    def __call__(self, pool, run, roll, tile_size, batch_size=1):
+        start = timer()
+        result = self.eval_sc_grad(pool, run, roll, tile_size, batch_size)
+        self.seconds += timer() - start
+        self.tiles += len(st.tile_bounds(self.model.img.shape[-2:], tile_size))
+        return result
+
+
+def bench_tiles(args):
+    """Runs style transfer end-to-end with each tile batch size and prints the style+content
+    gradient throughput in tiles per second. Requires Caffe."""
+    print_('batch_size,tiles,seconds,tiles_per_sec')
+    pool = None
+    for size in args.batch_sizes:
+        st.ARGS = st.make_parser().parse_args(
+            [args.content_image, args.style_image, '--tile-batch', size, '--seed', str(args.seed),
+             '--no-browser'] + args.transfer_args)
+        model = st.load_model()
+        transfer = st.StyleTransfer(model)
+        transfer.pool = pool
+        transfer.start_pool()
+        pool = transfer.pool
+        model.eval_sc_grad = tile_timer = TileTimer(model)
+        np.random.seed(args.seed)
+        transfer.transfer_multiscale(
+            [Image.open(args.content_image).convert('RGB')],
+            [Image.open(args.style_image).convert('RGB')], None, None, [], [],
+            callback=LossTrace())
+        print_('%s,%d,%.3f,%.1f' % (size, tile_timer.tiles, tile_timer.seconds,
+                                    tile_timer.tiles / tile_timer.seconds), flush=True)
+
+
+def main():
+    """CLI interface for the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog='Arguments after -- are passed to style_transfer.py by the end-to-end benchmarks.')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of timing repeats')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    p = subparsers.add_parser('jitter', help=bench_jitter.__doc__)
+    p.add_argument('--sizes', nargs='+', type=int, default=[1024, 2048, 4096],
+                   help='the image sizes')
+    p.add_argument('--tile-size', type=int, default=512, help='the maximum rendering tile size')
+    p.set_defaults(func=bench_jitter)
+
+    p = subparsers.add_parser('regularizers', help=bench_regularizers.__doc__)
+    p.add_argument('--sizes', nargs='+', type=int, default=[1024, 2048, 4096],
+                   help='the image sizes')
+    p.add_argument('--betas', nargs='+', type=float, default=[2, 1.5],
+                   help='the TV norm powers')
+    p.add_argument('--threads', type=int, help='the number of threads (default: all cores)')
+    p.set_defaults(func=bench_regularizers)
+
+    p = subparsers.add_parser('adam', help=bench_adam.__doc__)
+    p.add_argument('--sizes', nargs='+', type=int, default=[1024, 2048, 4096],
+                   help='the image sizes')
+    p.set_defaults(func=bench_adam)
+
+    p = subparsers.add_parser('optimizers', help=bench_optimizers.__doc__)
+    p.add_argument('content_image', help='the content image')
+    p.add_argument('style_image', help='the style image')
+    p.add_argument('--optimizers', nargs='+', default=['adam', 'lbfgs'],
+                   help='the optimizers to compare')
+    p.set_defaults(func=bench_optimizers)
+
+    p = subparsers.add_parser('tiles', help=bench_tiles.__doc__)
+    p.add_argument('content_image', help='the content image')
+    p.add_argument('style_image', help='the style image')
+    p.add_argument('--batch-sizes', nargs='+', default=['1', '2', '4', 'auto'],
+                   help='the tile batch sizes to compare')
+    p.set_defaults(func=bench_tiles)
+
+    argv, transfer_args = sys.argv[1:], []
+    if '--' in argv:
+        argv, transfer_args = argv[:argv.index('--')], argv[argv.index('--')+1:]
+    args = parser.parse_args(argv)
+    args.transfer_args = transfer_args
+    np.random.seed(args.seed)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
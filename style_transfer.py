@@ -8,8 +8,12 @@
 from __future__ import division
 
 import argparse
+import base64
 import configparser
-from collections import namedtuple, OrderedDict
+import copy
+import glob
+import hashlib
+from collections import deque, namedtuple, OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
 from functools import partial
@@ -19,11 +23,13 @@ import mmap
 import multiprocessing as mp
 import os
 import pickle
+import resource
 import shlex
 import sys
 import threading
 import time
 import webbrowser
+import zipfile
 
 import numpy as np
 from PIL import Image, PngImagePlugin
@@ -33,8 +39,10 @@ from scipy.ndimage import convolve, zoom
 import six
 from six import print_
 from six.moves import cPickle as pickle
+from six.moves import queue
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs, urlparse
 
 ARGS = None
 
@@ -51,6 +59,25 @@ EPS = np.finfo(np.float32).eps
 # Maximum number of MKL threads between all processes
 MKL_THREADS = None
 
+# The largest number of tiles per batch when the batch size is chosen automatically
+TILE_BATCH_MAX = 8
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss(pid='self'):
+    """Returns the current resident set size of a process in bytes, or None if it cannot be read
+    (e.g. on systems without /proc)."""
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
 
 def set_thread_count(threads):
     """Sets the maximum number of MKL threads for this process."""
@@ -145,6 +172,47 @@ def roll2(arr, xy):
     return np.roll(np.roll(arr, xy[0], -1), xy[1], -2)
 
 
+def roll2_index(shape, xy, start, end):
+    """Returns an index for an array of the given shape which selects the window from start to end
+    (in y, x order) of roll2(arr, xy), without translating the whole array. The window is clipped
+    to the array bounds. The index uses basic slicing unless the window wraps around an edge."""
+    h, w = shape[-2:]
+    dy, dx = np.minimum(end, (h, w)) - start
+    y0, x0 = (start[0] - xy[1]) % h, (start[1] - xy[0]) % w
+    if y0 + dy <= h and x0 + dx <= w:
+        return Ellipsis, slice(y0, y0+dy), slice(x0, x0+dx)
+    rows = (np.arange(dy) + y0) % h
+    cols = (np.arange(dx) + x0) % w
+    return Ellipsis, rows[:, None], cols
+
+
+def roll2_window(arr, xy, start, end):
+    """Returns the window from start to end (in y, x order) of roll2(arr, xy). The window is a view
+    unless it wraps around an edge."""
+    return arr[roll2_index(arr.shape, xy, start, end)]
+
+
+def tile_bounds(img_size, tile_size):
+    """Returns the (start, end) bounds (in y, x order) of the tiles covering an image of size
+    img_size with tiles no larger than tile_size. Tiles are equal in size except for the last row
+    and column, which extend to the image edges."""
+    img_size = np.array(img_size)
+    ntiles = (img_size-1) // tile_size + 1
+    tile_size = img_size // ntiles
+    bounds = []
+    for y in range(ntiles[0]):
+        for x in range(ntiles[1]):
+            xy = np.array([y, x])
+            start = xy * tile_size
+            end = start + tile_size
+            if y == ntiles[0] - 1:
+                end[0] = img_size[0]
+            if x == ntiles[1] - 1:
+                end[1] = img_size[1]
+            bounds.append((start, end))
+    return bounds
+
+
 def gram_matrix(feat):
     """Computes the Gram matrix corresponding to a feature map."""
     n, mh, mw = feat.shape
@@ -167,6 +235,127 @@ def tv_norm(x, beta=2):
     return loss, grad
 
 
+def band_dot(x, y):
+    """Returns the dot product of two float32 arrays with the same shape, which may be
+    non-contiguous, accumulated in float64 without copying them."""
+    return np.einsum('ijk,ijk->', x, y, dtype=np.float64)
+
+
+class RowBands:
+    """Runs a function over bands of rows of image-sized arrays in parallel threads. numpy
+    releases the GIL for elementwise operations on large arrays, so the bands run concurrently.
+    Bands hold about band_size elements, which is large enough to amortize the dispatch overhead
+    and small enough to stay in cache between the passes of an update. All RowBands with the same
+    thread count share one thread pool for the lifetime of the process."""
+    executors = {}
+    executors_lock = threading.Lock()
+
+    def __init__(self, shape, band_size=2**18, threads=None):
+        h = shape[-2]
+        band_rows = max(1, band_size // (int(np.prod(shape)) // h))
+        self.bands = [(r, min(r + band_rows, h)) for r in range(0, h, band_rows)]
+        threads = threads or os.cpu_count()
+        with self.executors_lock:
+            if threads not in self.executors:
+                self.executors[threads] = ThreadPoolExecutor(max_workers=threads)
+            self.executor = self.executors[threads]
+
+    def map(self, fn):
+        """Runs fn(r0, r1) for each band of rows and returns the sum of the results."""
+        return sum(self.executor.map(lambda band: fn(*band), self.bands))
+
+
+class Regularizers:
+    """Computes the weighted total variation and p-norm regularizer losses and gradients for
+    images of one shape in place, in preallocated workspaces, so that no full-size temporaries are
+    allocated per step. The image is processed in bands of rows in parallel. The returned gradient
+    is a view of a workspace which is overwritten by the next call."""
+    def __init__(self, shape, mean, threads=None):
+        self.shape = shape
+        self.mean = np.float32(mean).reshape((-1, 1, 1))
+        self.dx = np.zeros(shape, np.float32)
+        self.dy = np.zeros(shape, np.float32)
+        self.grad = np.zeros(shape, np.float32)
+        self.bands = RowBands(shape, threads=threads)
+
+    def tv_loss_band(self, img, r0, r1, beta):
+        """Computes the TV differences and loss for rows r0 to r1 of img / 255, leaving the
+        derivatives of the loss with respect to the differences in dx and dy."""
+        h = img.shape[-2]
+        dx, dy, tmp = self.dx[:, r0:r1], self.dy[:, r0:r1], self.grad[:, r0:r1]
+        np.subtract(img[:, r0:r1, :-1], img[:, r0:r1, 1:], out=dx[..., :-1])
+        np.subtract(img[:, r0:r1, -1], img[:, r0:r1, 0], out=dx[..., -1])
+        if r1 < h:
+            np.subtract(img[:, r0:r1], img[:, r0+1:r1+1], out=dy)
+        else:
+            np.subtract(img[:, r0:r1-1], img[:, r0+1:r1], out=dy[:, :-1])
+            np.subtract(img[:, -1], img[:, 0], out=dy[:, -1])
+        dx *= 1 / 255
+        dy *= 1 / 255
+        if beta == 2:
+            # The loss is the sum of squared differences and its derivative is linear
+            loss = band_dot(dx, dx) + band_dot(dy, dy) + EPS * dx.size
+            dx *= 2
+            dy *= 2
+            return loss
+        np.multiply(dx, dx, out=tmp)
+        grad_norm2 = np.multiply(dy, dy)
+        grad_norm2 += tmp
+        grad_norm2 += EPS
+        np.power(grad_norm2, beta/2, out=tmp)
+        loss = np.sum(tmp, dtype=np.float64)
+        np.power(grad_norm2, beta/2 - 1, out=tmp)
+        tmp *= beta
+        dx *= tmp
+        dy *= tmp
+        return loss
+
+    def tv_grad_band(self, r0, r1, weight):
+        """Computes the weighted TV gradient for rows r0 to r1 from dx and dy."""
+        dx, dy, grad = self.dx[:, r0:r1], self.dy[:, r0:r1], self.grad[:, r0:r1]
+        np.add(dx, dy, out=grad)
+        grad[..., 1:] -= dx[..., :-1]
+        grad[..., 0] -= dx[..., -1]
+        grad[:, 1:] -= dy[:, :-1]
+        grad[:, 0] -= self.dy[:, r0-1]
+        grad *= weight
+        return 0
+
+    def p_norm_band(self, img, r0, r1, p, weight):
+        """Adds the weighted p-norm gradient for rows r0 to r1 to the gradient, using dx and dy as
+        scratch space, and returns the weighted loss."""
+        scaled, img_pow, grad = self.dx[:, r0:r1], self.dy[:, r0:r1], self.grad[:, r0:r1]
+        np.add(img[:, r0:r1], self.mean, out=scaled)
+        scaled -= 127.5
+        scaled /= 127.5
+        np.abs(scaled, out=scaled)
+        np.power(scaled, p-1, out=img_pow)
+        loss = weight * band_dot(img_pow, scaled)
+        np.sign(img[:, r0:r1], out=scaled)
+        img_pow *= scaled
+        img_pow *= weight * p
+        grad += img_pow
+        return loss
+
+    def __call__(self, img, roll, tv_weight, tv_power, p_weight, p_power):
+        """Returns the summed weighted loss and gradient of the TV norm of img / 255, with the
+        gradient strengthened at the (jittered) image edges, and of the p-norm."""
+        loss = tv_weight * self.bands.map(partial(self.tv_loss_band, img, beta=tv_power))
+        self.bands.map(partial(self.tv_grad_band, weight=tv_weight))
+
+        # Selectively blur edges (of the jittered image) more to obscure jitter and tile seams
+        h, w = self.shape[-2:]
+        rows = (np.array([0, 1, h-2, h-1]) - roll[1]) % h
+        cols = (np.array([0, 1, w-2, w-1]) - roll[0]) % w
+        corners = self.grad[:, rows[:, None], cols]
+        self.grad[:, rows] *= 5
+        self.grad[:, :, cols] *= 5
+        self.grad[:, rows[:, None], cols] = corners * 5
+
+        loss += self.bands.map(partial(self.p_norm_band, img, p=p_power, weight=p_weight))
+        return np.float32(loss), self.grad
+
+
 # pylint: disable=no-member
 class SharedNDArray:
     """Creates an ndarray shared between processes using POSIX shared memory. It can be used to
@@ -200,7 +389,8 @@ class SharedNDArray:
         self._shm.unlink()
 
     def __del__(self):
-        self._buf.close()
+        # The mapping itself is released when the last ndarray viewing it is garbage collected,
+        # so views of the array may safely outlive this object.
         self._shm.close_fd()
 
     def __getstate__(self):
@@ -209,17 +399,157 @@ class SharedNDArray:
     def __setstate__(self, state):
         self.__init__(*state)
 
+    @property
+    def name(self):
+        """The name of the underlying POSIX shared memory segment."""
+        return self._shm.name
+
+
+class ArenaSlot:
+    """A region of a SharedArena segment viewed as an ndarray of a given shape. Like
+    SharedNDArray, it can be sent over multiprocessing.Pipe and Queue, but the receiving process
+    maps each segment only once."""
+    def __init__(self, segment, shape, dtype=np.float32, offset=0):
+        self.segment = segment
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+
+    @property
+    def array(self):
+        """The slot's contents as an ndarray."""
+        return np.ndarray(self.shape, self.dtype, self.segment.array, self.offset)
+
+    def __getstate__(self):
+        return (self.segment.name, self.segment.array.size, self.shape, self.dtype.str,
+                self.offset)
+
+    def __setstate__(self, state):
+        name, size, shape, dtype, offset = state
+        self.__init__(SharedArena.attach(name, size), shape, dtype, offset)
+
+
+class FileSlot:
+    """A read-only ndarray stored in a file at a given offset. Each process that receives it maps
+    the file itself, so that all of them share the page cache. It can be sent over
+    multiprocessing.Pipe and Queue."""
+    def __init__(self, filename, offset, shape, dtype=np.float32):
+        self.filename = filename
+        self.offset = offset
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_memmap(cls, arr):
+        """Creates a FileSlot referring to the same data as a numpy.memmap."""
+        return cls(arr.filename, arr.offset, arr.shape, arr.dtype)
+
+    @property
+    def array(self):
+        """The slot's contents as a read-only numpy.memmap."""
+        return np.memmap(self.filename, self.dtype, 'r', self.offset, self.shape)
+
+
+class SharedArena:
+    """A pool of POSIX shared memory segments which are reused between requests instead of being
+    created and unlinked for every tile. Segments are bucketed into power-of-two size classes."""
+    attached = {}
+
+    def __init__(self, min_size=4096):
+        self.min_size = min_size
+        self.segments = []
+        self.free = {}
+        self.created = 0
+        self.reused = 0
+
+    @classmethod
+    def attach(cls, name, size):
+        """Maps an existing segment into this process, reusing the mapping if it already
+        exists."""
+        if name not in cls.attached:
+            cls.attached[name] = SharedNDArray((size,), np.uint8, name)
+        return cls.attached[name]
+
+    @classmethod
+    def detach_all(cls):
+        """Forgets all segments mapped by attach()."""
+        cls.attached.clear()
+
+    def alloc(self, shape, dtype=np.float32):
+        """Returns a free slot big enough to hold an array of the given shape and dtype."""
+        nbytes = max(self.min_size, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        size_class = 1 << (nbytes - 1).bit_length()
+        free = self.free.setdefault(size_class, [])
+        if free:
+            segment = free.pop()
+            self.reused += 1
+        else:
+            segment = SharedNDArray((size_class,), np.uint8)
+            self.segments.append(segment)
+            self.attached[segment.name] = segment
+            self.created += 1
+        return ArenaSlot(segment, shape, dtype)
+
+    def copy(self, arr):
+        """Returns a slot containing a copy of the given ndarray."""
+        slot = self.alloc(arr.shape, arr.dtype)
+        slot.array[:] = arr
+        return slot
+
+    def pack(self, arrays, align=64):
+        """Copies a list of ndarrays into a single segment and returns a slot for each. The
+        segment is not released until the arena is cleared."""
+        offsets, total = [], 0
+        for arr in arrays:
+            offsets.append(total)
+            total += -(-arr.nbytes // align) * align
+        segment = self.alloc((max(1, total),), np.uint8).segment
+        slots = []
+        for arr, offset in zip(arrays, offsets):
+            slots.append(ArenaSlot(segment, arr.shape, arr.dtype, offset))
+            slots[-1].array[:] = arr
+        return slots
+
+    def release(self, slot):
+        """Returns a slot's segment to the pool for reuse."""
+        self.free[slot.segment.array.size].append(slot.segment)
+
+    def clear(self):
+        """Unlinks all segments and resets the reuse counts. Outstanding slots must not be used
+        afterward."""
+        for segment in self.segments:
+            segment.unlink()
+            self.attached.pop(segment.name, None)
+        self.segments = []
+        self.free = {}
+        self.created = self.reused = 0
+
+    def stats(self):
+        """Returns a string describing segment reuse since the last clear(), i.e. in the current
+        scale."""
+        return '%d shared memory segment(s) created, %d reused.' % (self.created, self.reused)
+
+    def usage(self):
+        """Returns the total size of the arena's segments and the size of those in use (not
+        released), in bytes."""
+        total = sum(segment.array.size for segment in list(self.segments))
+        free = sum(size * len(segments) for size, segments in list(self.free.items()))
+        return total, total - free
+
 
 class LayerIndexer:
-    """Helper class for accessing feature maps and gradients."""
+    """Helper class for accessing feature maps and gradients. Keys are layer names, which select
+    the first item of the batch, or (layer, index) pairs."""
     def __init__(self, net, attr):
         self.net, self.attr = net, attr
 
     def __getitem__(self, key):
-        return getattr(self.net.blobs[key], self.attr)[0]
+        layer, index = key if isinstance(key, tuple) else (key, 0)
+        return getattr(self.net.blobs[layer], self.attr)[index]
 
     def __setitem__(self, key, value):
-        getattr(self.net.blobs[key], self.attr)[0] = value
+        layer, index = key if isinstance(key, tuple) else (key, 0)
+        getattr(self.net.blobs[layer], self.attr)[index] = value
 
 
 class AdamOptimizer:
@@ -235,25 +565,61 @@ class AdamOptimizer:
         self.g1 = np.zeros_like(params)
         self.g2 = np.zeros_like(params)
         self.p1 = np.zeros_like(params)
+        self.bands, self.scratch, self.avg = None, None, None
+        self.update_time = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['bands'], state['scratch'], state['avg'] = None, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(bands=None, scratch=None, avg=None, update_time=0)
+        self.__dict__.update(state)
 
     def update(self, opfunc):
-        """Returns a step's parameter update given a loss/gradient evaluation function."""
+        """Returns a step's parameter update given a loss/gradient evaluation function. The update
+        is computed in place in parallel contiguous chunks, and the returned averaged iterate is a
+        buffer which is overwritten by the next call."""
         self.step += 1
         loss, grad = opfunc(self.params)
+        start_time = timer()
 
-        # Adam
-        self.g1 *= self.b1
-        axpy(1 - self.b1, grad, self.g1)
-        self.g2 *= self.b2
-        axpy(1 - self.b2, grad**2, self.g2)
+        if self.avg is None or self.avg.shape != self.params.shape:
+            # The chunks are bands of rows of the flattened arrays
+            self.bands = RowBands((self.params.size, 1))
+            self.scratch = np.zeros_like(self.params)
+            self.avg = np.zeros_like(self.params)
         step_size = self.step_size * np.sqrt(1-self.b2**self.step) / (1-self.b1**self.step)
-        step = self.g1 / (np.sqrt(self.g2) + EPS)
-        axpy(-step_size, step, self.params)
-
-        # Iterate averaging
-        self.p1 *= self.bp1
-        axpy(1 - self.bp1, self.params, self.p1)
-        return roll2(self.p1, -self.xy) / (1-self.bp1**self.step), loss
+        avg_scale = 1 / (1-self.bp1**self.step)
+        arrays = []
+        for arr in (self.g1, self.g2, self.p1, self.params, self.scratch, self.avg, grad):
+            arrays.append(arr.view())
+            arrays[-1].shape = (-1,)  # Raises rather than copying a non-contiguous array
+
+        def update_band(r0, r1):
+            g1, g2, p1, params, tmp, avg, g = [arr[r0:r1] for arr in arrays]
+
+            # Adam
+            g1 *= self.b1
+            axpy(1 - self.b1, g, g1)
+            g2 *= self.b2
+            np.square(g, out=tmp)
+            axpy(1 - self.b2, tmp, g2)
+            np.sqrt(g2, out=tmp)
+            tmp += EPS
+            np.divide(g1, tmp, out=tmp)
+            axpy(-step_size, tmp, params)
+
+            # Iterate averaging
+            p1 *= self.bp1
+            axpy(1 - self.bp1, params, p1)
+            np.multiply(p1, avg_scale, out=avg)
+            return 0
+
+        self.bands.map(update_band)
+        self.update_time = timer() - start_time
+        return roll2(self.avg, -self.xy), loss
 
     def roll(self, xy):
         """Rolls the optimizer's internal state."""
@@ -274,8 +640,20 @@ class AdamOptimizer:
         self.p1 = resize(self.p1, hw)
 
     def restore_state(self, optimizer):
-        """Given an AdamOptimizer instance, restores internal state from it."""
-        assert isinstance(optimizer, AdamOptimizer)
+        """Given an AdamOptimizer or LBFGSOptimizer instance, restores internal state from it.
+        Only the last iterate is taken from an LBFGSOptimizer, which has no moment estimates to
+        continue from; the moments and the iterate average start over from it."""
+        if isinstance(optimizer, LBFGSOptimizer):
+            self.params = optimizer.params
+            self.g1 = np.zeros_like(self.params)
+            self.g2 = np.zeros_like(self.params)
+            self.p1 = np.zeros_like(self.params)
+            self.step = 0
+            self.xy = np.zeros(2, dtype=np.int32)
+            return
+        if not isinstance(optimizer, AdamOptimizer):
+            raise ValueError('Cannot restore AdamOptimizer state from %s' %
+                             type(optimizer).__name__)
         self.params = optimizer.params
         self.g1 = optimizer.g1
         self.g2 = optimizer.g2
@@ -285,14 +663,256 @@ class AdamOptimizer:
         self.roll(-self.xy)
 
 
-FeatureMapRequest = namedtuple('FeatureMapRequest', 'resp img layers')
-FeatureMapResponse = namedtuple('FeatureMapResponse', 'resp features')
-SCGradRequest = namedtuple('SCGradRequest',
-                           '''resp img roll start content_layers style_layers dd_layers
-                           layer_weights content_weight style_weight dd_weight''')
-SCGradResponse = namedtuple('SCGradResponse', 'resp loss grad')
+class LBFGSOptimizer:
+    """Implements the limited-memory BFGS quasi-Newton method [6] with iterate averaging, taking one
+    gradient evaluation per step. There is no line search, since jitter makes each step's
+    objective slightly different (cf. [7]); instead, the mean absolute size of each step is
+    limited to step_size, and steps without curvature history are scaled to it. Curvature pairs
+    which do not satisfy s^T y > 0 are skipped."""
+    def __init__(self, params, step_size=1, history=5, bp1=0):
+        """Initializes the optimizer."""
+        self.params = params
+        self.step_size = step_size
+        self.history = history
+        self.bp1 = bp1
+
+        self.step = 0
+        self.xy = np.zeros(2, dtype=np.int32)
+        self.p1 = np.zeros_like(params)
+        self.pairs = []
+        self.last_step = None
+        self.last_grad = None
+        self.direction = None
+        self.avg = None
+        self.update_time = 0
+
+    def __getstate__(self):
+        # The curvature history is 2 * history image-sized arrays, and is not saved
+        state = self.__dict__.copy()
+        state.update(pairs=[], last_step=None, last_grad=None, direction=None, avg=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(direction=None, avg=None, update_time=0)
+        self.__dict__.update(state)
+
+    def compute_direction(self, grad):
+        """Computes the search direction -H grad with the two-loop recursion."""
+        q = self.direction
+        q[:] = grad
+        alphas = []
+        for s, y, rho in reversed(self.pairs):
+            alphas.append(rho * dot(s, q))
+            axpy(-alphas[-1], y, q)
+        s, y, _ = self.pairs[-1]
+        q *= dot(s, y) / dot(y, y)
+        for (s, y, rho), alpha in zip(self.pairs, reversed(alphas)):
+            axpy(alpha - rho * dot(y, q), s, q)
+        q *= -1
+        return q
+
+    def update(self, opfunc):
+        """Returns a step's parameter update given a loss/gradient evaluation function. The
+        returned averaged iterate is a buffer which is overwritten by the next call."""
+        self.step += 1
+        loss, grad = opfunc(self.params)
+        start_time = timer()
+
+        if self.direction is None or self.direction.shape != self.params.shape:
+            self.direction = np.zeros_like(self.params)
+            self.avg = np.zeros_like(self.params)
+
+        # Record the curvature pair from the previous step, reusing the oldest pair's buffers
+        if self.last_grad is not None:
+            if len(self.pairs) == self.history:
+                s, y, _ = self.pairs.pop(0)
+            else:
+                s, y = np.zeros_like(self.params), np.zeros_like(self.params)
+            s[:] = self.last_step
+            np.subtract(grad, self.last_grad, out=y)
+            sy = dot(s, y)
+            if sy > EPS * dot(y, y):
+                self.pairs.append((s, y, 1 / sy))
+        else:
+            self.last_step = np.zeros_like(self.params)
+            self.last_grad = np.zeros_like(self.params)
+
+        if self.pairs:
+            direction = self.compute_direction(grad)
+        else:
+            direction = self.direction
+            np.negative(grad, out=direction)
+        mean_step = np.mean(abs(direction)) + EPS
+        if mean_step > self.step_size or not self.pairs:
+            direction *= self.step_size / mean_step
+        self.params += direction
+        self.last_step[:] = direction
+        self.last_grad[:] = grad
+
+        # Iterate averaging
+        self.p1 *= self.bp1
+        axpy(1 - self.bp1, self.params, self.p1)
+        np.multiply(self.p1, 1 / (1-self.bp1**self.step), out=self.avg)
+        self.update_time = timer() - start_time
+        return self.avg, loss
+
+    def set_params(self, last_iterate):
+        """Sets params to the supplied array (a possibly-resized or altered last non-averaged
+        iterate). If the shape has changed, the averaged iterate is resampled and the curvature
+        history, which does not carry over between image sizes, is discarded."""
+        self.params = last_iterate
+        hw = self.params.shape[-2:]
+        if self.p1.shape[-2:] != hw:
+            self.p1 = resize(self.p1, hw)
+            self.pairs = []
+            self.last_step, self.last_grad = None, None
+
+    def restore_state(self, optimizer):
+        """Given an LBFGSOptimizer or AdamOptimizer instance, restores internal state from it. Only
+        the iterates are taken from an AdamOptimizer. The curvature history is not saved in state
+        files, so it is rebuilt after a restore."""
+        if not isinstance(optimizer, (LBFGSOptimizer, AdamOptimizer)):
+            raise ValueError('Cannot restore LBFGSOptimizer state from %s' %
+                             type(optimizer).__name__)
+        if isinstance(optimizer, AdamOptimizer):
+            optimizer.roll(-optimizer.xy)
+        else:
+            self.pairs = optimizer.pairs
+            self.last_step, self.last_grad = optimizer.last_step, optimizer.last_grad
+        self.params = optimizer.params
+        self.p1 = optimizer.p1
+        self.step = optimizer.step
+
+
+class EarlyStopping:
+    """Decides when a scale has converged, from the loss computed at each step, smoothed with an
+    exponential moving average. A step makes progress if the smoothed loss falls below its best
+    value so far by more than threshold (relative). The scale ends once no step has made progress
+    for patience steps, after at least min_steps. The update size is not used: Adam's keeps
+    shrinking long after the loss has flattened."""
+    def __init__(self, threshold, patience=10, min_steps=20, decay=0.9):
+        self.threshold = threshold
+        self.patience = patience
+        self.min_steps = min_steps
+        self.decay = decay
+        self.steps = 0
+        self.stale = 0
+        self.ema = None
+        self.best = None
+
+    def update(self, loss):
+        """Records a step's loss and returns True if the scale should end."""
+        self.steps += 1
+        if self.ema is None:
+            self.ema = self.best = float(loss)
+            return False
+        self.ema = self.decay * self.ema + (1 - self.decay) * loss
+        # Relative to the magnitude of the best value, which holds for negative losses too
+        if self.best - self.ema > self.threshold * abs(self.best):
+            self.best, self.stale = self.ema, 0
+        else:
+            self.stale += 1
+        return self.threshold > 0 and self.steps >= self.min_steps and \
+            self.stale >= self.patience
+
+
+class PhaseTimer:
+    """Accumulates the time spent in the named phases of a hot path. Each call to mark()
+    attributes the time since the previous mark() or start() to a phase. A disabled PhaseTimer
+    does nothing, so its calls can stay in place at close to no cost."""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = OrderedDict()
+        self.last = 0
+
+    def start(self):
+        """Starts timing the first phase."""
+        if self.enabled:
+            self.last = timer()
+
+    def mark(self, phase):
+        """Ends the current phase, attributing the time since the last mark to it."""
+        if self.enabled:
+            now = timer()
+            self.times[phase] = self.times.get(phase, 0) + now - self.last
+            self.last = now
+
+    def pop(self):
+        """Returns the accumulated phase times and resets them, or returns None if disabled."""
+        if not self.enabled:
+            return None
+        times, self.times = self.times, OrderedDict()
+        return times
+
+
+class TraceRecorder:
+    """Records Chrome trace events (viewable in chrome://tracing or Perfetto) for the master and
+    its TileWorkers. Times are timer() values in the master's clock; worker times are converted
+    with the offsets measured by TileWorkerPool.sync_clocks()."""
+    MASTER, REGULARIZERS = 0, 1
+
+    def __init__(self):
+        self.events = []
+        self.names = {0: 'master'}
+        self.offsets = {}
+        self.flow_id = 0
+
+    def worker_time(self, worker, t):
+        """Converts a worker's timer() value to the master's clock."""
+        return t - self.offsets.get(worker, 0)
+
+    def complete(self, name, start, end, pid=0, tid=MASTER, **args):
+        """Records a span from start to end."""
+        self.events.append(dict(name=name, ph='X', ts=start * 1e6, dur=(end - start) * 1e6,
+                                pid=pid, tid=tid, args=args))
+
+    def begin_async(self, name, t):
+        """Records the start of a span which may overlap others (e.g. a request in flight), and
+        returns its id for end_async()."""
+        self.flow_id += 1
+        self.events.append(dict(name=name, cat='request', ph='b', id=self.flow_id, ts=t * 1e6,
+                                pid=0, tid=self.MASTER))
+        return self.flow_id
+
+    def end_async(self, name, span_id, t):
+        """Records the end of a span started by begin_async()."""
+        self.events.append(dict(name=name, cat='request', ph='e', id=span_id, ts=t * 1e6, pid=0,
+                                tid=self.MASTER))
+
+    def write(self, filename):
+        """Writes the trace as Chrome trace event JSON."""
+        meta = [dict(name='process_name', ph='M', pid=pid, args=dict(name=name))
+                for pid, name in self.names.items()]
+        meta.append(dict(name='thread_name', ph='M', pid=0, tid=self.REGULARIZERS,
+                         args=dict(name='regularizers')))
+        with open(filename, 'w') as f:
+            json.dump(dict(traceEvents=meta + self.events, displayTimeUnit='ms'), f)
+
+
+FeatureMapRequest = namedtuple('FeatureMapRequest', 'resp img layers out')
+FeatureMapResponse = namedtuple('FeatureMapResponse', 'resp features worker start busy')
+GramRequest = namedtuple('GramRequest', 'resp img layers sizes out')
+# The same fields as FeatureMapResponse (features holds the Gram matrices), so that both can be
+# consumed alike; a separate type so that the trace names the work correctly
+GramResponse = namedtuple('GramResponse', 'resp features worker start busy')
+SCGradRequest = namedtuple('SCGradRequest', 'run roll tiles')
+SCGradResponse = namedtuple('SCGradResponse', 'tiles losses worker start busy phases')
+ConfigureRun = namedtuple('ConfigureRun',
+                          '''run img grad content_layers style_layers dd_layers layer_weights
+                          content_weight style_weight dd_weight time_phases''')
 SetContentsAndStyles = namedtuple('SetContentsAndStyles', 'contents styles')
 SetThreadCount = namedtuple('SetThreadCount', 'threads')
+StartFastPath = namedtuple('StartFastPath', 'run control')
+ResetArena = namedtuple('ResetArena', '')
+SyncClock = namedtuple('SyncClock', '')
+ClockResponse = namedtuple('ClockResponse', 'worker time')
+
+# The phases of a style+content gradient request timed by TileWorkers
+WORKER_PHASES = ('copy_in', 'forward', 'content', 'gram', 'deep_dream', 'backward', 'copy_out')
+
+# Fields of the fast path control block shared between the master and a TileWorker, followed by
+# the WORKER_PHASES times
+FAST_STOP, FAST_ROLL_X, FAST_ROLL_Y, FAST_LOSS, FAST_START, FAST_BUSY, FAST_PHASES = range(7)
 
 ContentData = namedtuple('ContentData', 'features masks')
 StyleData = namedtuple('StyleData', 'grams masks')
@@ -300,12 +920,15 @@ StyleData = namedtuple('StyleData', 'grams masks')
 
 class TileWorker:
     """Computes feature maps and gradients on the specified device in a separate process."""
-    def __init__(self, req_q, resp_q, model, device=-1):
+    def __init__(self, req_q, resp_q, model, device=-1, index=0):
         self.req_q = req_q
         self.resp_q = resp_q
+        self.index = index
         self.model = None
         self.model_info = (model.deploy, model.weights, model.mean, model.net_type, model.shapes)
         self.device = device
+        self.runs = {}
+        self.go, self.done = CTX.Semaphore(0), CTX.Semaphore(0)
         self.proc = CTX.Process(target=self.run)
         self.proc.daemon = True
         self.proc.start()
@@ -339,49 +962,104 @@ class TileWorker:
         """Receives one request from the master process and acts on it."""
         req = self.req_q.get()
         layers = []
+        start_time = timer()
 
         if isinstance(req, FeatureMapRequest):
             for layer in reversed(self.model.layers()):
                 if layer in req.layers:
                     layers.append(layer)
             features = self.model.eval_features_tile(req.img.array, layers)
-            req.img.unlink()
-            features_shm = {layer: SharedNDArray.copy(features[layer]) for layer in features}
-            self.resp_q.put(FeatureMapResponse(req.resp, features_shm))
+            for layer in features:
+                req.out[layer].array[:] = features[layer]
+            self.resp_q.put(FeatureMapResponse(req.resp, req.out, self.index, start_time,
+                                               timer() - start_time))
+
+        if isinstance(req, GramRequest):
+            features = self.model.eval_features_tile(req.img.array, req.layers)
+            for layer, (dy, dx) in req.sizes.items():
+                feat = np.ascontiguousarray(features[layer][:, :dy, :dx])
+                feat = feat.reshape((feat.shape[0], -1))
+                req.out[layer].array[:] = blas.ssyrk(1, feat)
+            self.resp_q.put(GramResponse(req.resp, req.out, self.index, start_time,
+                                         timer() - start_time))
 
         if isinstance(req, SCGradRequest):
+            losses = self.eval_sc_grad(req.run, req.roll, req.tiles)
+            self.resp_q.put(SCGradResponse(req.tiles, losses, self.index, start_time,
+                                           timer() - start_time, self.model.phases.pop()))
+
+        if isinstance(req, StartFastPath):
+            self.fast_path(req.run, req.control.array)
+
+        if isinstance(req, ConfigureRun):
             for layer in reversed(self.model.layers()):
                 if layer in req.content_layers + req.style_layers + req.dd_layers:
                     layers.append(layer)
-            self.model.roll(req.roll, jitter_scale=1)
-            loss, grad = self.model.eval_sc_grad_tile(
-                req.img.array, req.start, layers, req.content_layers, req.style_layers,
-                req.dd_layers, req.layer_weights, req.content_weight, req.style_weight,
-                req.dd_weight)
-            req.img.unlink()
-            self.model.roll(-req.roll, jitter_scale=1)
-            self.resp_q.put(SCGradResponse(req.resp, loss, SharedNDArray.copy(grad)))
+            self.runs[req.run] = req, layers
 
         if isinstance(req, SetContentsAndStyles):
-            self.model.contents, self.model.styles = [], []
+            def read_only(slots):
+                arrays = {}
+                for layer, slot in slots.items():
+                    arrays[layer] = slot.array
+                    arrays[layer].flags.writeable = False
+                return arrays
 
+            self.model.contents, self.model.styles = [], []
             for content in req.contents:
-                features = \
-                    {layer: content.features[layer].array.copy() for layer in content.features}
-                masks = \
-                    {layer: content.masks[layer].array.copy() for layer in content.masks}
-                self.model.contents.append(ContentData(features, masks))
+                self.model.contents.append(
+                    ContentData(read_only(content.features), read_only(content.masks)))
             for style in req.styles:
-                grams = \
-                    {layer: style.grams[layer].array.copy() for layer in style.grams}
-                masks = \
-                    {layer: style.masks[layer].array.copy() for layer in style.masks}
-                self.model.styles.append(StyleData(grams, masks))
+                self.model.styles.append(StyleData(read_only(style.grams), read_only(style.masks)))
             self.resp_q.put(())
 
         if isinstance(req, SetThreadCount):
             set_thread_count(req.threads)
 
+        if isinstance(req, SyncClock):
+            self.resp_q.put(ClockResponse(self.index, timer()))
+
+        if isinstance(req, ResetArena):
+            self.runs.clear()
+            SharedArena.detach_all()
+
+    def eval_sc_grad(self, run_id, roll, tiles):
+        """Evaluates a batch of style+content gradient tiles for a configured run, writing the
+        gradients to the shared gradient buffer, and returns the per-tile losses."""
+        run, layers = self.runs[run_id]
+        phases = self.model.phases
+        phases.enabled = run.time_phases
+        phases.start()
+        indices = [roll2_index(run.img.shape, roll, start, end) for start, end in tiles]
+        losses, grads = self.model.eval_sc_grad_tiles(
+            [run.img.array[index] for index in indices], [start for start, _ in tiles], roll,
+            layers, run.content_layers, run.style_layers, run.dd_layers, run.layer_weights,
+            run.content_weight, run.style_weight, run.dd_weight)
+        for index, grad in zip(indices, grads):
+            run.grad.array[index] = grad
+        phases.mark('copy_out')
+        return losses
+
+    def fast_path(self, run_id, control):
+        """Evaluates the whole image as a single tile each time the master releases the go
+        semaphore, exchanging the roll and the loss through a shared control block instead of the
+        queues, until the master sets its stop field."""
+        run, _ = self.runs[run_id]
+        tile = (np.zeros(2, np.int64), np.array(run.img.shape[-2:]))
+        while True:
+            self.go.acquire()
+            if control[FAST_STOP]:
+                break
+            start_time = timer()
+            roll = np.int64(control[[FAST_ROLL_X, FAST_ROLL_Y]])
+            control[FAST_LOSS] = self.eval_sc_grad(run_id, roll, [tile])[0]
+            control[FAST_START] = start_time
+            control[FAST_BUSY] = timer() - start_time
+            phases = self.model.phases.pop()
+            if phases is not None:
+                control[FAST_PHASES:] = [phases.get(phase, 0) for phase in WORKER_PHASES]
+            self.done.release()
+
 
 class TileWorkerPoolError(Exception):
     """Indicates abnormal termination of TileWorker processes."""
@@ -389,36 +1067,222 @@ class TileWorkerPoolError(Exception):
 
 
 class TileWorkerPool:
-    """A collection of TileWorkers."""
-    def __init__(self, model, devices):
+    """A collection of TileWorkers. Tiles are dispatched to whichever workers have the fewest
+    outstanding requests, so faster workers and workers given smaller tiles take on more tiles."""
+    def __init__(self, model, devices, depth=2):
         self.workers = []
-        self.req_count = 0
-        self.next_worker = 0
+        self.run_count = 0
+        self.depth = depth
+        self.outstanding = np.zeros(len(devices), np.int32)
+        self.busy = np.zeros(len(devices))
+        self.tile_count = np.zeros(len(devices), np.int32)
+        self.wall = 0
+        # Tiles and busy time from earlier scales, so that the totals never go back down
+        self.past_busy = np.zeros(len(devices))
+        self.past_tile_count = np.zeros(len(devices), np.int64)
+        self.fast = None
+        self.round_trips = OrderedDict()
+        self.time_phases = False
+        self.phases = OrderedDict()
+        self.trace = None
+        self.in_flight = [deque() for _ in devices]
         self.resp_q = CTX.Queue()
+        self.arena = SharedArena()
         self.is_healthy = True
-        for device in devices:
-            self.workers.append(TileWorker(CTX.Queue(), self.resp_q, model, device))
+        for i, device in enumerate(devices):
+            self.workers.append(TileWorker(CTX.Queue(), self.resp_q, model, device, i))
 
     def __del__(self):
         self.is_healthy = False
         for worker in self.workers:
             worker.__del__()
+        self.arena.clear()
 
     def request(self, req):
-        """Enqueues a request."""
-        self.workers[self.next_worker].req_q.put(req)
-        self.req_count += 1
-        self.next_worker = (self.next_worker + 1) % len(self.workers)
-
-    def reset_next_worker(self):
-        """Sets the worker which will process the next request to worker 0."""
+        """Enqueues a tile request to the worker with the fewest outstanding requests."""
+        worker = np.argmin(self.outstanding)
+        if self.trace is not None:
+            name = '%s -> worker %d' % (type(req).__name__, worker)
+            self.in_flight[worker].append((name, self.trace.begin_async(name, timer())))
+        self.workers[worker].req_q.put(req)
+        self.outstanding[worker] += 1
+
+    def trace_response(self, resp):
+        """Records a response's time in flight and the span its worker was busy with it."""
+        name, span_id = self.in_flight[resp.worker].popleft()
+        self.trace.end_async(name, span_id, timer())
+        start = self.trace.worker_time(resp.worker, resp.start)
+        args = dict(tiles=len(resp.tiles)) if isinstance(resp, SCGradResponse) else {}
+        self.trace.complete(type(resp).__name__.replace('Response', ''), start,
+                            start + resp.busy, pid=resp.worker + 1, **args)
+
+    def sync_clocks(self, rounds=5):
+        """Measures the offset of each worker's clock from the master's for the trace recorder,
+        keeping the round trip with the least latency. No requests may be outstanding."""
+        for i, worker in enumerate(self.workers):
+            best = np.inf
+            for _ in range(rounds):
+                t0 = timer()
+                worker.req_q.put(SyncClock())
+                resp = self.resp_q.get()
+                t1 = timer()
+                if t1 - t0 < best:
+                    best = t1 - t0
+                    self.trace.offsets[i] = resp.time - (t0 + t1) / 2
+            self.trace.names[i + 1] = 'worker %d (device %d)' % (i, worker.device)
+
+    def map(self, reqs, count=None):
+        """Dispatches tile requests and yields their responses in order of completion. At most
+        depth requests are outstanding per worker at a time, and each further request goes to the
+        first worker to finish one, so that idle workers pull the remaining tiles. reqs may be an
+        iterator, which is consumed as requests are sent, if their count is given."""
+        count = len(reqs) if count is None else count
+        if MKL_THREADS is not None:
+            active_workers = min(len(self.workers), max(1, count))
+            self.set_thread_count(MKL_THREADS // active_workers)
+        start_time = timer()
+        reqs = iter(reqs)
+        pending = 0
+        for req in reqs:
+            self.ensure_healthy()
+            self.request(req)
+            pending += 1
+            if pending == len(self.workers) * self.depth:
+                break
+        while pending:
+            resp = self.resp_q.get()
+            pending -= 1
+            self.outstanding[resp.worker] -= 1
+            self.busy[resp.worker] += resp.busy
+            if self.trace is not None:
+                self.trace_response(resp)
+            self.tile_count[resp.worker] += len(resp.tiles) if isinstance(resp, SCGradResponse) \
+                else 1
+            if isinstance(resp, SCGradResponse):
+                if count == 1:
+                    self.add_round_trip('queues', timer() - start_time, resp.busy)
+                if resp.phases:
+                    self.add_phases(resp.phases)
+            req = next(reqs, None)
+            if req is not None:
+                self.ensure_healthy()
+                self.request(req)
+                pending += 1
+            yield resp
+        self.wall += timer() - start_time
+
+    def group_tiles(self, bounds, batch_size=1):
+        """Groups tile bounds into lists of up to batch_size equal-shaped tiles, each of which is
+        evaluated as one batch by a TileWorker. If batch_size is 'auto', the groups are made as
+        large as possible (up to TILE_BATCH_MAX) while still giving every worker depth requests
+        to keep it busy."""
+        shapes = OrderedDict()
+        for start, end in bounds:
+            shapes.setdefault(tuple(end - start), []).append((start, end))
+        groups = []
+        for tiles in shapes.values():
+            size = batch_size
+            if size == 'auto':
+                size = len(tiles) // (len(self.workers) * self.depth)
+                size = max(1, min(TILE_BATCH_MAX, size))
+            groups += [tiles[i:i+size] for i in range(0, len(tiles), size)]
+        return groups
+
+    def start_fast_path(self, run):
+        """Hands a worker the whole image of a configured run as a single tile, to be evaluated
+        once per fast_step() call without going through the queues, until stop_fast_path() is
+        called."""
+        self.stop_fast_path()
+        self.ensure_healthy()
         if MKL_THREADS is not None:
-            active_workers = max(1, self.req_count)
-            active_workers = min(len(self.workers), active_workers)
-            threads_per_process = MKL_THREADS // active_workers
-            self.set_thread_count(threads_per_process)
-        self.req_count = 0
-        self.next_worker = 0
+            self.set_thread_count(MKL_THREADS)
+        worker = int(np.argmin(self.outstanding))
+        control = self.arena.alloc((FAST_PHASES + len(WORKER_PHASES),), np.float64)
+        control.array[:] = 0
+        self.workers[worker].req_q.put(StartFastPath(run, control))
+        self.fast = worker, control.array
+
+    def fast_step(self, roll):
+        """Evaluates the fast path tile with the given roll and returns its loss."""
+        worker, control = self.fast
+        start_time = timer()
+        control[[FAST_ROLL_X, FAST_ROLL_Y]] = roll
+        self.workers[worker].go.release()
+        while not self.workers[worker].done.acquire(timeout=1):
+            self.ensure_healthy()
+        self.busy[worker] += control[FAST_BUSY]
+        self.tile_count[worker] += 1
+        self.wall += timer() - start_time
+        self.add_round_trip('fast path', timer() - start_time, control[FAST_BUSY])
+        if self.trace is not None:
+            start = self.trace.worker_time(worker, control[FAST_START])
+            self.trace.complete('SCGrad (fast path)', start, start + control[FAST_BUSY],
+                                pid=worker + 1)
+        if self.time_phases:
+            self.add_phases(zip(WORKER_PHASES, control[FAST_PHASES:]))
+        return float(control[FAST_LOSS])
+
+    def stop_fast_path(self):
+        """Returns the fast path worker, if any, to serving requests from its queue."""
+        if self.fast is not None:
+            worker, control = self.fast
+            control[FAST_STOP] = 1
+            self.workers[worker].go.release()
+            self.fast = None
+
+    def add_round_trip(self, path, wall, busy):
+        """Records the latency added by the master/worker round trip of a single-tile step."""
+        steps, overhead = self.round_trips.get(path, (0, 0))
+        self.round_trips[path] = steps + 1, overhead + max(0, wall - busy)
+
+    def add_phases(self, phases):
+        """Accumulates the phase times reported by a worker, given as a dict or (phase, seconds)
+        pairs."""
+        for phase, seconds in dict(phases).items():
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def pop_phases(self):
+        """Returns the worker phase times accumulated since the last call, summed over workers, in
+        WORKER_PHASES order."""
+        phases = OrderedDict((phase, self.phases.get(phase, 0)) for phase in WORKER_PHASES)
+        self.phases.clear()
+        return phases
+
+    def round_trip_ms(self, path):
+        """Returns the mean latency added by the round trip of a single-tile step on the given
+        path ('queues' or 'fast path'), in ms, or None if there were none."""
+        if path not in self.round_trips:
+            return None
+        steps, overhead = self.round_trips[path]
+        return overhead * 1000 / steps
+
+    def reset_load_stats(self):
+        """Resets the per-worker busy and idle time accounting for a new scale. The pool's lifetime
+        totals are kept."""
+        self.past_busy += self.busy
+        self.past_tile_count += self.tile_count
+        self.busy[:] = 0
+        self.tile_count[:] = 0
+        self.wall = 0
+        self.round_trips.clear()
+
+    def load_stats(self):
+        """Returns a string describing the tiles processed and the time spent busy and idle by each
+        worker while tiles were outstanding."""
+        lines = []
+        for i, worker in enumerate(self.workers):
+            idle = max(0, self.wall - self.busy[i])
+            lines.append('Worker %d (device %d): %d tile(s), %.2f s busy, %.2f s idle (%.0f%%).'
+                         % (i, worker.device, self.tile_count[i], self.busy[i], idle,
+                            100 * self.busy[i] / max(self.wall, 1e-9)))
+        queues, fast = self.round_trip_ms('queues'), self.round_trip_ms('fast path')
+        if fast is not None:
+            line = 'Single-tile round trip: %.2f ms/step on the fast path' % fast
+            if queues is not None:
+                line += ', %.2f ms/step through the queues (%.2f ms/step saved)' % (
+                    queues, queues - fast)
+            lines.append(line + '.')
+        return '\n'.join(lines)
 
     def ensure_healthy(self):
         """Checks for abnormal pool process termination."""
@@ -429,43 +1293,321 @@ class TileWorkerPool:
                 self.__del__()
                 raise TileWorkerPoolError('Pool malfunction; terminating')
 
+    def configure_run(self, img, grad, content_layers, style_layers, dd_layers, layer_weights,
+                      content_weight, style_weight, dd_weight, time_phases=False):
+        """Installs the static gradient configuration for a run in all TileWorkers, given the
+        shared image and gradient slots, and returns the run id to refer to it by. Runs are
+        forgotten when the arena is reset. If time_phases is true, the workers report the time
+        spent in each of WORKER_PHASES, which is collected by pop_phases()."""
+        self.run_count += 1
+        self.time_phases = time_phases
+        self.phases.clear()
+        config = ConfigureRun(self.run_count, img, grad, content_layers, style_layers, dd_layers,
+                              layer_weights, content_weight, style_weight, dd_weight,
+                              time_phases)
+        for worker in self.workers:
+            worker.req_q.put(config)
+        return self.run_count
+
+    def reset_arena(self):
+        """Frees the tile traffic shared memory segments and forgets configured runs, e.g. before
+        starting a new scale."""
+        self.stop_fast_path()
+        for worker in self.workers:
+            worker.req_q.put(ResetArena())
+        self.arena.clear()
+
     def set_contents_and_styles(self, contents, styles):
-        """Propagates feature maps and Gram matrices to all TileWorkers."""
+        """Publishes feature maps, layer masks, and Gram matrices to all TileWorkers as a single
+        read-only shared memory segment, which is freed when the arena is reset. Arrays which are
+        read-only memory-mapped files (e.g. from a StylePack) are mapped by the workers
+        directly instead."""
+        def is_mapped(arr):
+            return isinstance(arr, np.memmap) and arr.mode == 'r'
+
+        arrays = []
+        for content in contents:
+            arrays += list(content.features.values()) + list(content.masks.values())
+        for style in styles:
+            arrays += list(style.grams.values()) + list(style.masks.values())
+        shared = iter(self.arena.pack([arr for arr in arrays if not is_mapped(arr)]))
+        slots = iter([FileSlot.from_memmap(arr) if is_mapped(arr) else next(shared)
+                      for arr in arrays])
+
         content_shms, style_shms = [], []
+        for content in contents:
+            features_shm = {layer: next(slots) for layer in content.features}
+            masks_shm = {layer: next(slots) for layer in content.masks}
+            content_shms.append(ContentData(features_shm, masks_shm))
+        for style in styles:
+            grams_shm = {layer: next(slots) for layer in style.grams}
+            masks_shm = {layer: next(slots) for layer in style.masks}
+            style_shms.append(StyleData(grams_shm, masks_shm))
 
         for worker in self.workers:
-            for content in contents:
-                features_shm = {layer: SharedNDArray.copy(content.features[layer])
-                                for layer in content.features}
-                masks_shm = {layer: SharedNDArray.copy(content.masks[layer])
-                             for layer in content.masks}
-                content_shms.append(ContentData(features_shm, masks_shm))
-
-            for style in styles:
-                grams_shm = {layer: SharedNDArray.copy(style.grams[layer])
-                             for layer in style.grams}
-                masks_shm = {layer: SharedNDArray.copy(style.masks[layer])
-                             for layer in style.masks}
-                style_shms.append(StyleData(grams_shm, masks_shm))
-
             worker.req_q.put(SetContentsAndStyles(content_shms, style_shms))
-
         for worker in self.workers:
             self.resp_q.get()
 
-        for shm in content_shms:
-            _ = [shm.unlink() for shm in shm.features.values()]
-            _ = [shm.unlink() for shm in shm.masks.values()]
-        for shm in style_shms:
-            _ = [shm.unlink() for shm in shm.grams.values()]
-            _ = [shm.unlink() for shm in shm.masks.values()]
-
     def set_thread_count(self, threads):
         """Sets the MKL thread count per worker process."""
         for worker in self.workers:
             worker.req_q.put(SetThreadCount(threads))
 
 
+def file_digest(path, _digests={}):  # pylint: disable=dangerous-default-value
+    """Returns the SHA-1 hex digest of a file's contents, which is computed once per process."""
+    if path not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, 2**20), b''):
+                sha.update(chunk)
+        _digests[path] = sha.hexdigest()
+    return _digests[path]
+
+
+class StyleCache:
+    """An on-disk cache of style Gram matrices, bounded in total size by evicting the least
+    recently used entries. Entries are .npz files named by their key. The Gram matrices do not
+    depend on the style masks, which are cheap to recompute, so the masks are not cached."""
+    def __init__(self, path, max_size, style_scale=1):
+        self.path = path
+        self.max_size = max_size
+        self.style_scale = style_scale
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, model, image, layers, tile_size, passes, stream_grams=False):
+        """Returns the cache key for a (resized) style image."""
+        sha = hashlib.sha1()
+        sha.update(image.tobytes())
+        settings = [
+            image.size, self.style_scale, list(layers), tile_size, passes,
+            file_digest(model.deploy), file_digest(model.weights), model.mean.ravel().tolist(),
+        ]
+        if stream_grams:
+            settings.append('stream_grams')
+        sha.update(json.dumps(settings).encode())
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Returns the Gram matrices for a key, or None if they are not present."""
+        entry = self.load(key)
+        if entry is None:
+            self.misses += 1
+            print_('Style cache miss (%s).' % key[:12])
+        else:
+            self.hits += 1
+            print_('Style cache hit (%s).' % key[:12])
+        return entry
+
+    def put(self, key, grams):
+        """Stores an entry, evicting other entries if necessary."""
+        self.store(key, grams)
+
+    def load(self, key):
+        """Reads an entry from disk, or returns None if it is not present. Corrupt entries (e.g.
+        truncated by a crash) are deleted."""
+        filename = os.path.join(self.path, key + '.npz')
+        try:
+            with np.load(filename) as npz:
+                grams = {name: npz[name] for name in npz.files}
+            os.utime(filename)
+        except IOError:
+            return None
+        except (ValueError, EOFError, zipfile.BadZipFile) as err:
+            print_('Removing corrupt style cache entry %s: %s' % (key[:12], err))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+        return grams
+
+    def store(self, key, grams):
+        """Writes an entry to disk, then evicts entries until the cache fits in its maximum
+        size."""
+        filename = os.path.join(self.path, key + '.npz')
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **grams)
+        os.replace(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in its maximum size."""
+        entries = []
+        for filename in glob.glob(os.path.join(self.path, '*.npz')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        """Returns a string describing cache effectiveness."""
+        return 'Style cache: %d hit(s), %d miss(es).' % (self.hits, self.misses)
+
+
+class MemoryStyleCache(StyleCache):
+    """A StyleCache kept in memory for the lifetime of the process, holding the max_entries most
+    recently used entries."""
+    def __init__(self, max_entries=32, style_scale=1):  # pylint: disable=super-init-not-called
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.style_scale = style_scale
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key):
+        if key not in self.entries:
+            return None
+        self.entries[key] = self.entries.pop(key)
+        return self.entries[key]
+
+    def store(self, key, grams):
+        self.entries[key] = grams
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class StylePack:
+    """A file of precomputed style Gram matrices for a style image at several sizes, which can be
+    used in place of the image. The file begins with a magic number, the length of a JSON header,
+    and the header, which indexes the float32 Gram matrices stored after it. The Gram matrices are
+    memory-mapped read-only so that concurrent jobs share them through the page cache."""
+    magic = b'STYLPAK1'
+    align = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError('%s is not a style pack' % filename)
+            header_len = int(np.frombuffer(f.read(8), '<u8')[0])
+            self.header = json.loads(f.read(header_len).decode())
+        self.entries = {tuple(entry['size']): entry['grams'] for entry in self.header['entries']}
+        self.size = tuple(self.header['size'])
+
+    @classmethod
+    def is_pack(cls, filename):
+        """Returns True if filename is a style pack."""
+        with open(filename, 'rb') as f:
+            return f.read(len(cls.magic)) == cls.magic
+
+    @classmethod
+    def header_for(cls, model, size, layers, tile_size, passes, stream_grams=False):
+        """Returns the header fields which must match between a pack and the job using it."""
+        return OrderedDict([
+            ('size', list(size)), ('layers', list(layers)), ('tile_size', tile_size),
+            ('passes', passes), ('deploy', file_digest(model.deploy)),
+            ('weights', file_digest(model.weights)), ('mean', model.mean.ravel().tolist()),
+            ('stream_grams', stream_grams),
+        ])
+
+    @classmethod
+    def write(cls, filename, header, entries):
+        """Writes a style pack, given a header from header_for() and a dict mapping each (w, h)
+        size to a dict of Gram matrices."""
+        header = OrderedDict(header, entries=[])
+        offset = 0
+        for size, grams in entries.items():
+            index = OrderedDict()
+            for layer, gram in grams.items():
+                index[layer] = [offset, gram.shape[0]]
+                offset += -(-gram.nbytes // cls.align) * cls.align
+            header['entries'].append({'size': list(size), 'grams': index})
+        # The header records where the data starts, so grow data_start until the header holding
+        # it fits in front of it.
+        data_start = 0
+        while True:
+            header['data_start'] = data_start
+            header_bytes = json.dumps(header).encode()
+            needed = len(cls.magic) + 8 + len(header_bytes)
+            if needed <= data_start:
+                break
+            data_start = -(-needed // cls.align) * cls.align
+        padding = data_start - len(cls.magic) - 8 - len(header_bytes)
+        assert padding >= 0
+        header_bytes += b' ' * padding
+        with open(filename, 'wb') as f:
+            f.write(cls.magic + np.uint64(len(header_bytes)).astype('<u8').tobytes())
+            f.write(header_bytes)
+            for grams in entries.values():
+                for gram in grams.values():
+                    data = np.ascontiguousarray(gram, np.float32).tobytes()
+                    f.write(data + b'\0' * (-len(data) % cls.align))
+
+    def resize(self, size, _=None):
+        """Returns a view of the pack at a different size, as with PIL.Image.resize()."""
+        pack = copy.copy(self)
+        pack.size = tuple(size)
+        return pack
+
+    def check(self, model):
+        """Raises ValueError if the pack was made with settings or sizes which do not match the
+        current arguments."""
+        layers, _ = StyleTransfer.parse_weights(ARGS.style_layers, 1)
+        self.check_settings(model, layers, ARGS.tile_size, stream_grams=ARGS.stream_style_grams)
+        self.check_sizes()
+
+    def check_settings(self, model, layers, tile_size, passes=10, stream_grams=False):
+        """Raises ValueError if the pack's Gram matrices were computed with settings incompatible
+        with a job's, or lack some of its style layers."""
+        header = self.header_for(model, self.size, layers, tile_size, passes, stream_grams)
+        names = OrderedDict([
+            ('tile_size', '--tile-size'), ('passes', 'number of feature passes'),
+            ('deploy', '--model'), ('weights', '--weights'), ('mean', '--mean'),
+            ('stream_grams', '--stream-style-grams'),
+        ])
+        different = [name for field, name in names.items()
+                     if header[field] != self.header.get(field, False)]
+        if different:
+            raise ValueError('Style pack %s was made with a different %s; make it with the same '
+                             'options as the run.' % (self.filename, ', '.join(different)))
+        missing = [layer for layer in layers if layer not in self.header['layers']]
+        if missing:
+            raise ValueError('Style pack %s lacks the style layer(s) %s. It has %s.' % (
+                self.filename, ', '.join(missing), ', '.join(self.header['layers'])))
+
+    def check_sizes(self):
+        """Raises ValueError, listing the sizes the pack has, if it lacks any of the sizes used by
+        the scales of the current --size, --min-size, and --style-scale."""
+        sizes = [resize_to_fit(self, round(size * ARGS.style_scale),
+                               scale_up=ARGS.style_scale_up).size for size in scale_sizes()]
+        missing = [size for size in sizes if size not in self.entries]
+        if missing:
+            raise ValueError(
+                'Style pack %s has no entry for size %s. It has sizes %s; make it with the same '
+                '--size, --min-size, and --style-scale as the run.' % (
+                    self.filename, ', '.join('%dx%d' % size for size in missing),
+                    ', '.join('%dx%d' % size for size in sorted(self.entries))))
+
+    def grams(self, model, layers, tile_size, passes, stream_grams=False):
+        """Returns the pack's Gram matrices at its current size, checking that they were computed
+        with settings compatible with the current job."""
+        self.check_settings(model, layers, tile_size, passes, stream_grams)
+        if self.size not in self.entries:
+            raise ValueError('Style pack %s has no entry for size %dx%d' %
+                             ((self.filename,) + self.size))
+        grams = {}
+        for layer in layers:
+            offset, ch = self.entries[self.size][layer]
+            grams[layer] = np.memmap(self.filename, np.float32, 'r',
+                                     self.header['data_start'] + offset, (ch, ch))
+        return grams
+
+
 class CaffeModel:
     """A Caffe neural network model."""
     def __init__(self, deploy, weights, mean=(0, 0, 0), net_type=None, shapes=None,
@@ -486,7 +1628,10 @@ class CaffeModel:
             self.diff = LayerIndexer(self.net, 'diff')
         self.contents = []
         self.styles = []
+        self.phases = PhaseTimer()
         self.img = None
+        self.img_slot = None
+        self.grad_slot = None
 
     def get_image(self, params=None):
         """Gets the current model input (or provided alternate input) as a PIL image."""
@@ -509,6 +1654,15 @@ class CaffeModel:
         """Sets the current model input to a PIL image."""
         self.img = self.pil_to_image(img)
 
+    def share_image(self, arena):
+        """Moves the current model input into shared memory and allocates a shared gradient
+        buffer of the same shape, so that TileWorkers can read tiles and write gradients in
+        place. Returns the new model input array."""
+        self.img_slot = arena.copy(self.img)
+        self.grad_slot = arena.alloc(self.img.shape)
+        self.img = self.img_slot.array
+        return self.img
+
     def resize_image(self, size):
         """Resamples the current model input to a different size."""
         self.img = np.ascontiguousarray(resize(self.img, size[::-1]))
@@ -557,210 +1711,270 @@ class CaffeModel:
         self.net.forward(end=self.last_layer)
         return {layer: self.data[layer] for layer in layers}
 
-    def eval_features_once(self, pool, layers, tile_size=512):
-        """Computes the set of feature maps for an image."""
-        img_size = np.array(self.img.shape[-2:])
-        ntiles = (img_size-1) // tile_size + 1
-        tile_size = img_size // ntiles
-        print_('Using %dx%d tiles of size %dx%d.' %
-               (ntiles[1], ntiles[0], tile_size[1], tile_size[0]))
-        features = {}
-        for layer in layers:
-            scale, channels = self.layer_info(layer)
-            shape = (channels,) + tuple(np.int32(np.ceil(img_size / scale)))
-            features[layer] = np.zeros(shape, dtype=np.float32)
-        for y in range(ntiles[0]):
-            for x in range(ntiles[1]):
-                xy = np.array([y, x])
-                start = xy * tile_size
-                end = start + tile_size
-                if y == ntiles[0] - 1:
-                    end[0] = img_size[0]
-                if x == ntiles[1] - 1:
-                    end[1] = img_size[1]
-                tile = self.img[:, start[0]:end[0], start[1]:end[1]]
-                pool.ensure_healthy()
-                pool.request(FeatureMapRequest(start, SharedNDArray.copy(tile), layers))
-        pool.reset_next_worker()
-        for _ in range(np.prod(ntiles)):
-            start, feats_tile = pool.resp_q.get()
-            for layer, feat in feats_tile.items():
-                scale, _ = self.layer_info(layer)
-                start_f = start // scale
-                end_f = start_f + np.array(feat.array.shape[-2:])
-                features[layer][:, start_f[0]:end_f[0], start_f[1]:end_f[1]] = feat.array
-                feat.unlink()
-
-        return features
+    def prepare_features_many(self, pool, images, layers, tile_size=512, passes=10,
+                              grams=None):
+        """Averages the sets of feature maps for several images over multiple passes each to
+        obscure tiling. Each pass tiles its image as if it had been translated by a random
+        offset. The offsets are drawn from a generator seeded by the image's contents rather than
+        from the global one, so that they do not depend on which other images are computed (e.g.
+        on style cache hits) and do not shift the global random stream. The tiles of every pass
+        of every image are submitted to the pool at once, and are accumulated into the averages
+        as they arrive. images and layers are parallel lists of image arrays and of the layers to
+        compute for each. Returns a list of dicts of feature maps.
+
+        grams, if given, is a parallel list of bools. For the images for which it is True, the
+        TileWorkers return each tile's contribution to the Gram matrices instead of its feature
+        maps, and the Gram matrices (averaged over the passes) are returned in place of feature
+        maps, so that memory use does not depend on the image size."""
+        grams = grams or [False] * len(images)
+        results, plans, ntiles_total = [], [], 0
+        for img, img_layers, as_grams in zip(images, layers, grams):
+            img_size = np.array(img.shape[-2:])
+            ntiles = (img_size-1) // tile_size + 1
+            tile = img_size // ntiles
+            print_('Using %dx%d tiles of size %dx%d.' % (ntiles[1], ntiles[0], tile[1], tile[0]))
+            img_passes = 1 if max(*img_size) <= tile_size else passes
+            result = {}
+            for layer in img_layers:
+                scale, channels = self.layer_info(layer)
+                shape = (channels,) + tuple(np.int32(np.ceil(img_size / scale)))
+                result[layer] = np.zeros((channels, channels) if as_grams else shape, np.float32)
+            rng = np.random.RandomState(int(hashlib.sha1(img.tobytes()).hexdigest()[:8], 16))
+            for i in range(img_passes):
+                xy = np.array((0, 0))
+                if i > 0:
+                    xy = np.int32(rng.uniform(size=2) * img_size) // 32
+                plans.append((len(results), img, img_layers, as_grams, xy * 32, 1 / img_passes))
+            results.append(result)
+            ntiles_total += img_passes * np.prod(ntiles)
+
+        def requests():
+            # Tile slots are allocated as the pool asks for requests, so that only the tiles in
+            # flight occupy shared memory
+            for i, img, img_layers, as_grams, roll, weight in plans:
+                img_size = np.array(img.shape[-2:])
+                for start, end in tile_bounds(img_size, tile_size):
+                    tile = pool.arena.copy(roll2_window(img, roll, start, end))
+                    crops, out = {}, {}
+                    for layer in img_layers:
+                        # Each tile contributes the part of the feature map from its own start
+                        # to the next tile's start, so that tiles whose feature windows overlap
+                        # by rounding are not counted twice
+                        scale, channels = self.layer_info(layer)
+                        shape = np.int32(np.ceil((end - start) / scale))
+                        start_f = start // scale
+                        end_f = np.where(end == img_size, -(-img_size // scale), end // scale)
+                        crops[layer] = (start_f, np.minimum(end_f, start_f + shape))
+                        out[layer] = pool.arena.alloc(
+                            (channels, channels) if as_grams else (channels,) + tuple(shape))
+                    resp = i, roll, weight, crops, tile
+                    if as_grams:
+                        sizes = {layer: tuple(end_f - start_f)
+                                 for layer, (start_f, end_f) in crops.items()}
+                        yield GramRequest(resp, tile, img_layers, sizes, out)
+                    else:
+                        yield FeatureMapRequest(resp, tile, img_layers, out)
+
+        for resp in pool.map(requests(), ntiles_total):
+            i, roll, weight, crops, tile = resp.resp
+            pool.arena.release(tile)
+            for layer, feat in resp.features.items():
+                if grams[i]:
+                    axpy(weight, feat.array, results[i][layer])
+                else:
+                    scale, _ = self.layer_info(layer)
+                    start_f, end_f = crops[layer]
+                    index = roll2_index(results[i][layer].shape, np.int32(roll) // scale,
+                                        start_f, end_f)
+                    dy, dx = end_f - start_f
+                    results[i][layer][index] += weight * feat.array[:, :dy, :dx]
+                pool.arena.release(feat)
+
+        # Normalize the Gram matrices' sums of products as gram_matrix() does
+        for img, img_layers, result, as_grams in zip(images, layers, results, grams):
+            for layer in img_layers if as_grams else []:
+                scale, channels = self.layer_info(layer)
+                result[layer] /= channels * np.prod(np.ceil(np.array(img.shape[-2:]) / scale))
+        return results
 
     def prepare_features(self, pool, layers, tile_size=512, passes=10):
-        """Averages the set of feature maps for an image over multiple passes to obscure tiling."""
-        img_size = np.array(self.img.shape[-2:])
-        if max(*img_size) <= tile_size:
-            passes = 1
-        features = {}
-        for i in range(passes):
-            xy = np.array((0, 0))
-            if i > 0:
-                xy = np.int32(np.random.uniform(size=2) * img_size) // 32
-            self.roll(xy)
-            self.roll_features(features, xy)
-            feats = self.eval_features_once(pool, layers, tile_size)
-            for layer in layers:
-                if i == 0:
-                    features[layer] = feats[layer] / passes
-                else:
-                    axpy(1 / passes, feats[layer], features[layer])
-            self.roll(-xy)
-            self.roll_features(features, -xy)
-        return features
+        """Averages the set of feature maps for the current image over multiple passes to obscure
+        tiling."""
+        return self.prepare_features_many(pool, [self.img], [layers], tile_size, passes)[0]
+
+    def prepare_grams(self, pool, layers, tile_size=512, passes=10, stream=False):
+        """Returns the Gram matrices of the current image's feature maps, averaged over multiple
+        passes to obscure tiling. If stream is True, they are accumulated from per-tile partial
+        sums instead of from full-size feature maps."""
+        if stream:
+            return self.prepare_features_many(pool, [self.img], [layers], tile_size, passes,
+                                              grams=[True])[0]
+        feats = self.prepare_features(pool, layers, tile_size, passes)
+        return {layer: gram_matrix(feats[layer]) for layer in layers}
 
     def preprocess_images(self, pool, content_images, style_images, content_layers, style_layers,
-                          content_masks, style_masks, tile_size=512):
-        """Performs preprocessing tasks on the input images."""
+                          content_masks, style_masks, tile_size=512, passes=10,
+                          style_cache=None, stream_grams=False):
+        """Performs preprocessing tasks on the input images. Style images may be StylePacks. If
+        style_cache (a StyleCache) is given, each style image's Gram matrices are looked up in it
+        first. If stream_grams is True, style Gram matrices are accumulated from
+        per-tile partial sums (see prepare_features_many())."""
         # Construct list of layers to visit during the backward pass
         layers = []
         for layer in reversed(self.layers()):
             if layer in content_layers or layer in style_layers:
                 layers.append(layer)
 
-        # Prepare Gram matrices from style image
+        # Look up style images' Gram matrices, and collect the style images which are not cached
+        # and the content images for feature map computation through the pool all at once
         print_('Preprocessing the style image...')
+        entries, keys, images, image_layers, as_grams = [], [], [], [], []
+        for image, mask in zip(style_images, style_masks):
+            key, entry = None, None
+            if isinstance(image, StylePack):
+                entry = image.grams(self, style_layers, tile_size, passes, stream_grams)
+            elif style_cache:
+                key = style_cache.key(self, image, style_layers, tile_size, passes, stream_grams)
+                entry = style_cache.get(key)
+            if not entry:
+                self.set_image(image)
+                images.append(self.img)
+                image_layers.append(style_layers)
+                as_grams.append(stream_grams)
+            entries.append(entry)
+            keys.append(key)
+        for image in content_images:
+            print_('Preprocessing the content image...')
+            self.set_image(image)
+            images.append(self.img)
+            image_layers.append(content_layers)
+            as_grams.append(False)
+        feats = iter(self.prepare_features_many(pool, images, image_layers, tile_size, passes,
+                                                as_grams))
+
+        # Prepare Gram matrices from style image
         grams = {}
         for layer in style_layers:
             _, ch = self.layer_info(layer)
             grams[layer] = np.zeros((ch, ch), np.float32)
-        for image, mask in zip(style_images, style_masks):
-            self.set_image(image)
-            feats = self.prepare_features(pool, style_layers, tile_size)
-            for layer in feats:
-                axpy(1 / len(style_images), gram_matrix(feats[layer]), grams[layer])
+        for entry, key, mask in zip(entries, keys, style_masks):
+            if entry:
+                image_grams = entry
+            else:
+                image_grams = next(feats)
+                if not stream_grams:
+                    image_grams = {layer: gram_matrix(feat) for layer, feat in image_grams.items()}
+                if style_cache:
+                    style_cache.put(key, image_grams)
             masks = self.make_layer_masks(mask)
+            if len(style_images) == 1:
+                grams = image_grams
+            else:
+                for layer in image_grams:
+                    axpy(1 / len(style_images), image_grams[layer], grams[layer])
             self.styles.append(StyleData(grams, masks))
 
         # Prepare feature maps from content image
-        for image, mask in zip(content_images, content_masks):
-            print_('Preprocessing the content image...')
-            self.set_image(image)
-            feats = self.prepare_features(pool, content_layers, tile_size)
+        for mask in content_masks:
             masks = self.make_layer_masks(mask)
-            self.contents.append(ContentData(feats, masks))
+            self.contents.append(ContentData(next(feats), masks))
 
         return layers
 
-    def eval_sc_grad_tile(self, img, start, layers, content_layers, style_layers, dd_layers,
-                          layer_weights, content_weight, style_weight, dd_weight):
-        """Evaluates an individual style+content gradient tile."""
-        self.net.blobs['data'].reshape(1, 3, *img.shape[-2:])
-        self.data['data'] = img
-        loss = 0
+    def eval_sc_grad_tiles(self, imgs, starts, roll, layers, content_layers, style_layers,
+                           dd_layers, layer_weights, content_weight, style_weight, dd_weight):
+        """Evaluates the style+content gradients of a batch of equal-shaped tiles with one forward
+        and backward pass, returning the per-tile losses and the gradients as a batch. The
+        feature maps and layer masks are read as if they had been translated by roll."""
+        self.net.blobs['data'].reshape(len(imgs), 3, *imgs[0].shape[-2:])
+        for n, img in enumerate(imgs):
+            self.data['data', n] = img
+        losses = np.zeros(len(imgs))
+        self.phases.mark('copy_in')
 
         # Prepare gradient buffers and run the model forward
         for layer in layers:
-            self.diff[layer] = 0
+            self.diff[layer, :] = 0
         self.net.forward(end=layers[0])
+        self.phases.mark('forward')
 
         for i, layer in enumerate(layers):
             lw = layer_weights[layer]
             scale, _ = self.layer_info(layer)
-            start_ = start // scale
-            end = start_ + np.array(self.data[layer].shape[-2:])
+            roll_ = roll // scale
 
             def eval_c_grad(layer, content):
-                nonlocal loss
-                feat = content.features[layer][:, start_[0]:end[0], start_[1]:end[1]]
-                c_grad = (self.data[layer] - feat) * \
-                    content.masks[layer][start_[0]:end[0], start_[1]:end[1]]
-                loss += lw * content_weight[layer] * norm2(c_grad)
-                axpy(lw * content_weight[layer], normalize(c_grad), self.diff[layer])
+                feat = roll2_window(content.features[layer], roll_, start_, end)
+                c_grad = (data - feat) * roll2_window(content.masks[layer], roll_, start_, end)
+                losses[n] += lw * content_weight[layer] * norm2(c_grad)
+                axpy(lw * content_weight[layer], normalize(c_grad), diff)
 
             def eval_s_grad(layer, style):
-                nonlocal loss
-                current_gram = gram_matrix(self.data[layer])
-                n, mh, mw = self.data[layer].shape
-                feat = self.data[layer].reshape((n, mh * mw))
+                current_gram = gram_matrix(data)
+                c, mh, mw = data.shape
+                feat = data.reshape((c, mh * mw))
                 s_grad = blas.ssymm(1, current_gram - style.grams[layer], feat)
-                s_grad = s_grad.reshape((n, mh, mw))
-                s_grad *= style.masks[layer][start_[0]:end[0], start_[1]:end[1]]
-                loss += lw * style_weight[layer] * norm2(current_gram - style.grams[layer]) * \
-                    np.mean(style.masks[layer][start_[0]:end[0], start_[1]:end[1]]) / 2
-                axpy(lw * style_weight[layer], normalize(s_grad), self.diff[layer])
-
-            # Compute the content and style gradients
-            if layer in content_layers:
-                for content in self.contents:
-                    eval_c_grad(layer, content)
-            if layer in style_layers:
-                for style in self.styles:
-                    eval_s_grad(layer, style)
-            if layer in dd_layers:
-                loss -= lw * dd_weight[layer] * norm2(self.data[layer])
-                axpy(-lw * dd_weight[layer], normalize(self.data[layer]), self.diff[layer])
+                s_grad = s_grad.reshape((c, mh, mw))
+                mask = roll2_window(style.masks[layer], roll_, start_, end)
+                s_grad *= mask
+                losses[n] += lw * style_weight[layer] * \
+                    norm2(current_gram - style.grams[layer]) * np.mean(mask) / 2
+                axpy(lw * style_weight[layer], normalize(s_grad), diff)
+
+            # Compute the content and style gradients of each tile
+            for n, start in enumerate(starts):
+                data, diff = self.data[layer, n], self.diff[layer, n]
+                start_ = start // scale
+                end = start_ + np.array(data.shape[-2:])
+                if layer in content_layers:
+                    for content in self.contents:
+                        eval_c_grad(layer, content)
+                    self.phases.mark('content')
+                if layer in style_layers:
+                    for style in self.styles:
+                        eval_s_grad(layer, style)
+                    self.phases.mark('gram')
+                if layer in dd_layers:
+                    losses[n] -= lw * dd_weight[layer] * norm2(data)
+                    axpy(-lw * dd_weight[layer], normalize(data), diff)
+                    self.phases.mark('deep_dream')
 
             # Run the model backward
             if i+1 == len(layers):
                 self.net.backward(start=layer)
             else:
                 self.net.backward(start=layer, end=layers[i+1])
+            self.phases.mark('backward')
 
-        return loss, self.diff['data']
+        return losses.tolist(), self.diff['data', :]
 
-    def eval_sc_grad(self, pool, roll, content_layers, style_layers, dd_layers, layer_weights,
-                     content_weight, style_weight, dd_weight, tile_size):
-        """Evaluates the summed style and content gradients."""
+    def eval_sc_grad(self, pool, run, roll, tile_size, batch_size=1):
+        """Evaluates the summed style and content gradients for a run configured with
+        TileWorkerPool.configure_run(). The image is tiled as if it had been translated by roll
+        (jitter), without moving it in memory. Up to batch_size equal-shaped tiles are evaluated
+        per request (see TileWorkerPool.group_tiles()), unless the pool's fast path is active.
+        The returned gradient is a view of a shared buffer which is overwritten by the next
+        call."""
         loss = 0
-        grad = np.zeros_like(self.img)
-        img_size = np.array(self.img.shape[-2:])
-        ntiles = (img_size-1) // tile_size + 1
-        tile_size = img_size // ntiles
-
-        for y in range(ntiles[0]):
-            for x in range(ntiles[1]):
-                xy = np.array([y, x])
-                start = xy * tile_size
-                end = start + tile_size
-                if y == ntiles[0] - 1:
-                    end[0] = img_size[0]
-                if x == ntiles[1] - 1:
-                    end[1] = img_size[1]
-                tile = self.img[:, start[0]:end[0], start[1]:end[1]]
-                pool.ensure_healthy()
-                pool.request(
-                    SCGradRequest((start, end), SharedNDArray.copy(tile), roll, start,
-                                  content_layers, style_layers, dd_layers, layer_weights,
-                                  content_weight, style_weight, dd_weight))
-        pool.reset_next_worker()
-        for _ in range(np.prod(ntiles)):
-            (start, end), loss_tile, grad_tile = pool.resp_q.get()
-            loss += loss_tile
-            grad[:, start[0]:end[0], start[1]:end[1]] = grad_tile.array
-            grad_tile.unlink()
+        img, grad = self.img_slot.array, self.grad_slot.array
+        if not np.shares_memory(self.img, img):
+            img[:] = self.img
+        if pool.fast is not None:
+            return pool.fast_step(roll), grad
+        bounds = tile_bounds(self.img.shape[-2:], tile_size)
+        reqs = [SCGradRequest(run, roll, tiles) for tiles in pool.group_tiles(bounds, batch_size)]
+        for resp in pool.map(reqs):
+            loss += sum(resp.losses)
 
         return loss, grad
 
-    def roll_features(self, feats, xy, jitter_scale=32):
-        """Rolls an individual set of feature maps in-place."""
-        xy = xy * jitter_scale
-
-        for layer, feat in feats.items():
-            scale, _ = self.layer_info(layer)
-            feats[layer][:] = roll2(feat, xy // scale)
-
-        return feats
-
-    def roll(self, xy, jitter_scale=32):
-        """Rolls image, feature maps, and layer masks."""
-        for content in self.contents:
-            self.roll_features(content.features, xy, jitter_scale)
-            self.roll_features(content.masks, xy, jitter_scale)
-        for style in self.styles:
-            self.roll_features(style.masks, xy, jitter_scale)
-
-        self.img[:] = roll2(self.img, xy * jitter_scale)
-
 
 class StyleTransfer:
     """Performs style transfer."""
+    # Computes the regularizers while the workers compute the tile gradients. It is shared by all
+    # instances, since the job server and batch mode make one per job or row.
+    executor = ThreadPoolExecutor(max_workers=1)
+
     def __init__(self, model):
         self.model = model
         self.layer_weights = {layer: 1.0 for layer in self.model.layers() + ['data']}
@@ -772,7 +1986,26 @@ class StyleTransfer:
         self.current_raw = None
         self.optimizer = None
         self.pool = None
+        self.regularizers = None
+        self.timeline = []
+        self.steps_used = 0
+        self.loop_time = 0
+        self.scale_budget = None
+        self.end_reason = None
+        self.scales = []
+        self.trace = TraceRecorder() if ARGS.trace else None
+        self.style_cache = None
+        if ARGS.style_cache:
+            self.style_cache = StyleCache(ARGS.style_cache, ARGS.style_cache_size * 2**20,
+                                          ARGS.style_scale)
         self.step = 0
+        self.logs_started = False
+
+    def start_pool(self):
+        """Starts the TileWorker processes, unless a healthy pool is already running."""
+        if self.pool is None or not self.pool.is_healthy:
+            print_('Starting %d worker process(es).' % len(ARGS.devices))
+            self.pool = TileWorkerPool(self.model, ARGS.devices)
 
     @staticmethod
     def parse_weights(args, master_weight):
@@ -790,87 +2023,139 @@ class StyleTransfer:
             total += abs(weights[name])
         return names, {name: weight * master_weight / total for name, weight in weights.items()}
 
-    def eval_loss_and_grad(self, img, sc_grad_args):
-        """Returns the summed loss and gradient."""
-        old_img = self.model.img
-        self.model.img = img
+    def eval_regularizers(self, img, roll):
+        """Returns the summed loss and gradient of the regularizers, which depend only on the image
+        and the jitter offset. It is run in a thread, concurrently with the tile gradients."""
+        start_time = timer()
         lw = self.layer_weights['data']
 
-        # Compute style+content gradient
-        loss, grad = self.model.eval_sc_grad(*sc_grad_args)
-        normalize(grad)
-
-        # Compute total variation gradient
-        tv_loss, tv_grad = tv_norm(self.model.img / 255, beta=ARGS.tv_power)
-        loss += lw * ARGS.tv_weight * tv_loss
-
-        # Selectively blur edges more to obscure jitter and tile seams
-        tv_mask = np.ones_like(tv_grad)
-        tv_mask[:, :2, :] = 5
-        tv_mask[:, -2:, :] = 5
-        tv_mask[:, :, :2] = 5
-        tv_mask[:, :, -2:] = 5
-        tv_grad *= tv_mask
-        axpy(lw * ARGS.tv_weight, tv_grad, grad)
-
-        # Compute p-norm regularizer gradient (from jcjohnson/cnn-vis and [3])
-        p = ARGS.p_power
-        img_scaled = abs((self.model.img + self.model.mean - 127.5) / 127.5)
-        img_pow = img_scaled**(p-1)
-        loss += lw * ARGS.p_weight * np.sum(img_pow * img_scaled)
-        p_grad = p * np.sign(self.model.img) * img_pow
-        axpy(lw * ARGS.p_weight, p_grad, grad)
+        # Compute total variation and p-norm (from jcjohnson/cnn-vis and [3]) gradients
+        loss, grad = self.regularizers(img, roll, lw * ARGS.tv_weight, ARGS.tv_power,
+                                       lw * ARGS.p_weight, ARGS.p_power)
 
         # Compute auxiliary image gradient
         if self.aux_image is not None:
-            aux_grad = (self.model.img - self.aux_image) / 255
+            aux_grad = (img - self.aux_image) / 255
             loss += lw * ARGS.aux_weight * norm2(aux_grad)
             axpy(lw * ARGS.aux_weight, aux_grad, grad)
 
+        self.timeline.append(('regularizers', start_time, timer()))
+        return loss, grad
+
+    def eval_loss_and_grad(self, img, run, roll):
+        """Returns the summed loss and gradient, jittering the image by roll."""
+        old_img = self.model.img
+        self.model.img = img
+
+        # Compute the regularizers in the background while the workers compute the style+content
+        # gradient
+        reg_future = self.executor.submit(self.eval_regularizers, img, roll)
+        start_time = timer()
+        loss, grad = self.model.eval_sc_grad(self.pool, run, roll, ARGS.tile_size,
+                                             ARGS.tile_batch)
+        self.timeline.append(('tiles', start_time, timer()))
+        normalize(grad)
+
+        start_time = timer()
+        reg_loss, reg_grad = reg_future.result()
+        self.timeline.append(('wait', start_time, timer()))
+        loss += reg_loss
+        grad += reg_grad
+
         self.model.img = old_img
         return loss, grad
 
     def transfer(self, iterations, params, content_images, style_images,
-                 content_masks, style_masks, callback=None):
-        """Performs style transfer from style_image to content_image."""
+                 content_masks, style_masks, callback=None, time_budget=None):
+        """Performs style transfer from style_image to content_image. If time_budget is given, it
+        is called with the timer() value at which preprocessing finished and returns the number
+        of seconds the steps may take; the scale ends at the last step which is expected to
+        finish in that time."""
         content_layers, content_weight = self.parse_weights(ARGS.content_layers,
                                                             ARGS.content_weight)
         style_layers, style_weight = self.parse_weights(ARGS.style_layers, 1)
         dd_layers, dd_weight = self.parse_weights(ARGS.dd_layers, ARGS.dd_weight)
 
         self.model.contents, self.model.styles = [], []
+        self.model.img_slot, self.model.grad_slot = None, None
+        self.pool.reset_arena()
+        self.pool.reset_load_stats()
+        if self.trace is not None:
+            self.pool.trace = self.trace
+            self.pool.sync_clocks()
+        start_time = timer()
         layers = self.model.preprocess_images(
             self.pool, content_images, style_images, content_layers, style_layers,
-            content_masks, style_masks, ARGS.tile_size)
+            content_masks, style_masks, ARGS.tile_size, style_cache=self.style_cache,
+            stream_grams=ARGS.stream_style_grams)
+        if self.trace is not None:
+            self.trace.complete('preprocess_images', start_time, timer(), scale=self.step + 1)
         self.pool.set_contents_and_styles(self.model.contents, self.model.styles)
         self.model.img = params
+        self.regularizers = Regularizers(params.shape, self.model.mean)
+        # The image and its gradient live in shared memory for the duration of the scale
+        self.optimizer.params = params = self.model.share_image(self.pool.arena)
+        run = self.pool.configure_run(
+            self.model.img_slot, self.model.grad_slot, content_layers, style_layers, dd_layers,
+            self.layer_weights, content_weight, style_weight, dd_weight,
+            time_phases=bool(ARGS.phase_log))
 
         old_img = self.model.img.copy()
         self.step += 1
-        log = open('log.csv', 'w')
-        print_('step', 'loss', 'img_size', 'update_size', 'tv_loss', sep=',', file=log, flush=True)
+        new_logs, self.logs_started = not self.logs_started, True
+        if new_logs:
+            log = open('log.csv', 'w')
+            print_('scale', 'step', 'loss', 'img_size', 'update_size', 'tv_loss', 'end_reason',
+                   sep=',', file=log, flush=True)
+        else:
+            log = open('log.csv', 'a')
+        phase_log = None
+        if ARGS.phase_log:
+            phase_log = open(ARGS.phase_log, 'w' if new_logs else 'a')
+        early_stopping = EarlyStopping(ARGS.stop_threshold, ARGS.stop_patience,
+                                       ARGS.stop_min_steps)
+        self.end_reason = 'iterations'
+        self.steps_used = 0
+        loop_start = timer()
+        self.scale_budget = deadline = None
+        if time_budget is not None:
+            self.scale_budget = time_budget(loop_start)
+            deadline = loop_start + self.scale_budget
+        timeline = None
+        if ARGS.timeline:
+            timeline = open(ARGS.timeline, 'w' if new_logs else 'a')
+            if new_logs:
+                print_('scale', 'step', 'phase', 'start_ms', 'end_ms', sep=',', file=timeline)
+        phase_times = {}
+        # Images which fit in one tile skip the queues after the first step (see
+        # TileWorkerPool.start_fast_path())
+        fast_path = not ARGS.no_fast_path and max(*params.shape[-2:]) <= ARGS.tile_size
 
         for step in range(1, iterations+1):
-            # Forward jitter
+            step_start = timer()
+            busy = self.pool.busy.copy()
+            del self.timeline[:]
+            if fast_path and step == 2:
+                self.pool.start_fast_path(run)
+
+            # Jitter
             jitter_scale, _ = self.model.layer_info([l for l in layers if l in content_layers][0])
             xy = np.array((0, 0))
             img_size = np.array(self.model.img.shape[-2:])
             if max(*img_size) > ARGS.tile_size:
                 xy = np.int32(np.random.uniform(-0.5, 0.5, size=2) * img_size) // jitter_scale
-            self.model.roll(xy, jitter_scale=jitter_scale)
-            self.optimizer.roll(xy * jitter_scale)
-
-            # In-place gradient descent update
-            args = (self.pool, xy * jitter_scale, content_layers, style_layers, dd_layers,
-                    self.layer_weights, content_weight, style_weight, dd_weight, ARGS.tile_size)
-            avg_img, loss = self.optimizer.update(partial(self.eval_loss_and_grad,
-                                                          sc_grad_args=args))
 
-            # Backward jitter
-            self.model.roll(-xy, jitter_scale=jitter_scale)
-            self.optimizer.roll(-xy * jitter_scale)
+            # In-place gradient descent update. The jitter is virtual: tiles, feature maps, and
+            # layer masks are read at an offset instead of being translated in memory.
+            update_start = timer()
+            avg_img, loss = self.optimizer.update(partial(self.eval_loss_and_grad, run=run,
+                                                          roll=xy * jitter_scale))
+            update_end = timer()
+            phase_times['optimizer'] = (phase_times.get('optimizer', 0) +
+                                        self.optimizer.update_time)
 
             # Compute image size statistic
+            start_time = timer()
             img_size = np.mean(abs(avg_img))
 
             # Compute update size statistic
@@ -881,43 +2166,138 @@ class StyleTransfer:
             x_diff = avg_img - np.roll(avg_img, -1, axis=-1)
             y_diff = avg_img - np.roll(avg_img, -1, axis=-2)
             tv_loss = np.sum(x_diff**2 + y_diff**2) / avg_img.size
+            self.timeline.append(('statistics', start_time, timer()))
 
             # Record current output
+            start_time = timer()
             self.current_raw = avg_img
             self.current_output = self.model.get_image(avg_img)
-
-            print_(step, loss / avg_img.size, img_size, update_size, tv_loss, sep=',', file=log,
-                   flush=True)
+            self.timeline.append(('get_image', start_time, timer()))
+
+            if early_stopping.update(loss / avg_img.size):
+                self.end_reason = 'converged'
+            elif deadline is not None and timer() + (timer() - loop_start) / step > deadline:
+                self.end_reason = 'deadline'
+            end_reason = self.end_reason if step == iterations or \
+                self.end_reason != 'iterations' else ''
+            print_(self.step, step, loss / avg_img.size, img_size, update_size, tv_loss,
+                   end_reason, sep=',', file=log, flush=True)
+            # The timeline holds only disjoint phases, so they can be summed; the update and the
+            # step enclose them and are recorded in the trace only
+            step_end = timer()
+            for phase, start, end in self.timeline:
+                phase_times[phase] = phase_times.get(phase, 0) + end - start
+                if timeline:
+                    print_(self.step, step, phase, '%.2f' % ((start - step_start) * 1000),
+                           '%.2f' % ((end - step_start) * 1000), sep=',', file=timeline)
+            if self.trace is not None:
+                self.trace.complete('step', step_start, step_end, scale=self.step, step=step)
+                self.trace.complete('update', update_start, update_end, scale=self.step,
+                                    step=step)
+                for phase, start, end in self.timeline:
+                    tid = TraceRecorder.REGULARIZERS if phase == 'regularizers' else \
+                        TraceRecorder.MASTER
+                    self.trace.complete(phase, start, end, tid=tid, scale=self.step, step=step)
+            if phase_log:
+                master = OrderedDict()
+                for phase, start, end in self.timeline:
+                    master[phase] = round((end - start) * 1000, 3)
+                master['optimizer'] = round(self.optimizer.update_time * 1000, 3)
+                workers = OrderedDict((phase, round(seconds * 1000, 3))
+                                      for phase, seconds in self.pool.pop_phases().items())
+                print_(json.dumps(OrderedDict([
+                    ('scale', self.step), ('step', step), ('master_ms', master),
+                    ('worker_ms', workers),
+                    ('worker_busy_ms', [round(t * 1000, 3) for t in self.pool.busy - busy]),
+                ])), file=phase_log, flush=True)
 
             if callback is not None:
                 callback(step=step, update_size=update_size, loss=loss / avg_img.size,
                          tv_loss=tv_loss)
+            self.steps_used = step
+            if self.end_reason == 'converged':
+                print_('Scale converged after %d steps.' % step)
+                break
+            if self.end_reason == 'deadline':
+                print_('Scale reached its time budget after %d steps.' % step)
+                break
 
+        self.loop_time = timer() - loop_start
+        self.pool.stop_fast_path()
+        for f in (log, timeline, phase_log):
+            if f:
+                f.close()
+        if self.trace is not None:
+            self.trace.write(ARGS.trace)
+        print_(self.pool.arena.stats())
+        print_(self.pool.load_stats())
+        if phase_times.get('regularizers'):
+            hidden = phase_times['regularizers'] - phase_times['wait']
+            print_('Regularizers: %.1f ms/step, %.0f%% overlapped with the tile gradients.' %
+                   (phase_times['regularizers'] * 1000 / max(self.steps_used, 1),
+                    100 * max(0, hidden) / phase_times['regularizers']))
+        print_('Optimizer: %.1f ms/step; peak memory use %.0f MB.' %
+               (phase_times.get('optimizer', 0) * 1000 / max(self.steps_used, 1),
+                peak_rss() / 2**20))
+        if self.style_cache:
+            print_(self.style_cache.stats())
         return self.current_output
 
     def transfer_multiscale(self, content_images, style_images, initial_image, aux_image,
                             content_masks, style_masks, initial_state=None, callback=None,
-                            **kwargs):
-        """Performs style transfer from style_image to content_image at the given sizes."""
+                            scales=None, **kwargs):
+        """Performs style transfer from style_image to content_image at the given sizes. If scales
+        is given, only that many of the finest scales are run."""
         output_image = None
         output_raw = None
-        print_('Starting %d worker process(es).' % len(ARGS.devices))
-        self.pool = TileWorkerPool(self.model, ARGS.devices)
-
-        size = ARGS.size
-        sizes = [ARGS.size]
-        while True:
-            size = round(size / np.sqrt(2))
-            if size < ARGS.min_size:
-                break
-            sizes.append(size)
+        self.start_pool()
+        # self.step numbers the scales of this call, for the logs, the trace, and /status
+        self.step = 0
 
-        steps = 0
-        for i in range(len(sizes)):
-            steps += ARGS.iterations[min(i, len(ARGS.iterations)-1)]
-        callback.set_steps(steps)
+        sizes = scale_sizes()[:scales]
+        nominal = [ARGS.iterations[min(i, len(ARGS.iterations)-1)] for i in range(len(sizes))]
+        callback.set_steps(sum(nominal))
+        steps_done = 0
+        carried_steps = 0
+        self.scales = []
+        budget_end = timer() + (ARGS.time_budget or 0)
+        # Time budget cost estimates, per unit of size**2 (proportional to the pixel count): the
+        # measured seconds per step, and the measured fixed overhead of a scale (resizing,
+        # preprocessing, and Gram matrices) in seconds
+        areas = [size**2 for size in reversed(sizes)]
+        step_cost, setup_cost = None, 0
+
+        def allot(now, i, scale_start):
+            """Returns the seconds available for scale i's steps once its preprocessing finished
+            at now. The time left, less the expected overhead of the later scales, is divided
+            between the remaining scales in proportion to the expected time of their nominal
+            steps (the measured cost per step times their pixel count)."""
+            spare = budget_end - now - (now - scale_start) / areas[i] * sum(areas[i+1:])
+            work = [nominal[j] * (step_cost or 1) * areas[j] for j in range(i, len(areas))]
+            budget = max(0, spare) * work[0] / sum(work)
+            if step_cost:
+                # Every remaining scale runs the same fraction of its nominal steps
+                fraction = max(0, spare) / sum(work)
+                expected = [max(1, int(fraction * n)) for n in nominal[i:]]
+                if ARGS.stop_max_steps:
+                    expected = [min(n, ARGS.stop_max_steps) for n in expected]
+                print_('Time budget for this scale: %.2f s (about %d steps).' %
+                       (budget, expected[0]))
+                callback.set_steps(steps_done + sum(expected))
+            else:
+                print_('Time budget for this scale: %.2f s.' % budget)
+            return budget
 
         for i, size in enumerate(reversed(sizes)):
+            scale_start = timer()
+            if ARGS.time_budget and output_image and \
+                    budget_end - scale_start - setup_cost * areas[i] <= 0:
+                w, h = resize_to_fit(content_images[0], size, scale_up=True).size
+                print_('\nNo time budget left for scale %d (%dx%d); skipping it.' % (i+1, w, h))
+                self.scales.append(OrderedDict([
+                    ('scale', i+1), ('size', [w, h]), ('steps', 0), ('seconds', 0),
+                    ('overhead', 0), ('budget', 0), ('end_reason', 'skipped')]))
+                continue
             content_scaled = []
             content_masks_scaled = []
             for image in content_images:
@@ -957,8 +2337,13 @@ class StyleTransfer:
 
                 # make sure the optimizer's params array shares memory with self.model.img
                 # after preprocess_image is called later
-                self.optimizer = AdamOptimizer(
-                    self.model.img, step_size=ARGS.step_size, bp1=1-(1/ARGS.avg_window))
+                if ARGS.optimizer == 'lbfgs':
+                    self.optimizer = LBFGSOptimizer(
+                        self.model.img, step_size=ARGS.lbfgs_step_size, history=ARGS.lbfgs_history,
+                        bp1=1-(1/ARGS.avg_window))
+                else:
+                    self.optimizer = AdamOptimizer(
+                        self.model.img, step_size=ARGS.step_size, bp1=1-(1/ARGS.avg_window))
 
                 if initial_state:
                     self.optimizer.restore_state(initial_state)
@@ -970,18 +2355,69 @@ class StyleTransfer:
                     self.model.img = self.optimizer.params
 
             params = self.model.img
-            iters_i = ARGS.iterations[min(i, len(ARGS.iterations)-1)]
+            iters_i = ARGS.iterations[min(i, len(ARGS.iterations)-1)] + carried_steps
+            time_budget = None
+            if ARGS.time_budget:
+                # The scale's share is worked out once its overhead is known
+                time_budget = partial(allot, i=i, scale_start=scale_start)
+                iters_i = ARGS.stop_max_steps or sys.maxsize
+            elif ARGS.stop_max_steps:
+                iters_i = min(iters_i, ARGS.stop_max_steps)
             output_image = self.transfer(iters_i, params, content_scaled, style_scaled,
                                          content_masks_scaled, style_masks_scaled, callback,
-                                         **kwargs)
+                                         time_budget=time_budget, **kwargs)
             output_raw = self.current_raw
-
+            steps_done += self.steps_used
+            callback.set_steps(steps_done + sum(nominal[i+1:]))
+            if ARGS.carry_steps and not ARGS.time_budget:
+                carried_steps = iters_i - self.steps_used
+            scale_time = timer() - scale_start
+            step_cost = self.loop_time / max(1, self.steps_used) / areas[i]
+            setup_cost = (scale_time - self.loop_time) / areas[i]
+            self.scales.append(OrderedDict([
+                ('scale', i+1), ('size', [w, h]), ('steps', self.steps_used),
+                ('seconds', scale_time), ('overhead', scale_time - self.loop_time),
+                ('budget', self.scale_budget),
+                ('end_reason', self.end_reason)]))
+
+        if self.scales[-1]['end_reason'] == 'skipped':
+            # The finest scales ran out of time: upscale the last output to the requested size
+            self.current_output = output_image = output_image.resize(
+                tuple(self.scales[-1]['size']), Image.LANCZOS)
+        self.pool.reset_arena()
         return output_image
 
+    def make_style_pack(self, style_image, filename, passes=10):
+        """Precomputes the style image's Gram matrices at every scale used by
+        transfer_multiscale() and writes them to a StylePack file."""
+        style_layers, _ = self.parse_weights(ARGS.style_layers, 1)
+        self.start_pool()
+
+        entries = OrderedDict()
+        for size in reversed(scale_sizes()):
+            image = resize_to_fit(style_image, round(size * ARGS.style_scale),
+                                  scale_up=ARGS.style_scale_up)
+            if image.size in entries:
+                continue
+            print_('Preprocessing the style image at size %dx%d...' % image.size)
+            self.pool.reset_arena()
+            self.model.set_image(image)
+            grams = self.model.prepare_grams(self.pool, style_layers, ARGS.tile_size, passes,
+                                             stream=ARGS.stream_style_grams)
+            entries[image.size] = OrderedDict((layer, grams[layer]) for layer in style_layers)
+        self.pool.reset_arena()
+
+        header = StylePack.header_for(self.model, style_image.size, style_layers, ARGS.tile_size,
+                                      passes, ARGS.stream_style_grams)
+        StylePack.write(filename, header, entries)
+
     def save_state(self, filename='out.state'):
-        """Saves the optimizer's internal state to disk."""
+        """Saves the optimizer's internal state to disk, along with the steps and time used at each
+        scale (as the saved optimizer's scales attribute; the live optimizer is not modified)."""
+        state = copy.copy(self.optimizer)
+        state.scales = self.scales
         with open(filename, 'wb') as f:
-            pickle.dump(self.optimizer, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
 
 
 class Progress:
@@ -1020,15 +2456,141 @@ class Progress:
         self.steps = steps
 
 
+class PreviewCache:
+    """Encodes the current output image for the progress server on demand, at most once per step
+    for each format and size requested, so that clients polling the preview do not re-encode it
+    on every request."""
+    content_types = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.image = None
+        self.version = 0
+        self.token = '%x' % int(time.time())
+        self.entries = {}
+
+    def get(self, image, fmt='png', size=None, quality=90):
+        """Returns the ETag and the encoded bytes of image in the given format ('png', 'jpeg', or
+        'webp'), downscaled to fit in size x size pixels if size is given. quality applies to
+        JPEG and WebP and is clamped to 1-100."""
+        # Normalize the parameters first so that requests which encode identically share a cache
+        # entry, and so that arbitrary client values cannot grow the cache without bound
+        if size is not None and size >= max(image.size):
+            size = None
+        if fmt == 'png':
+            quality = None
+        else:
+            quality = min(max(quality, 1), 100)
+        with self.lock:
+            if image is not self.image:
+                self.image, self.entries = image, {}
+                self.version += 1
+            key = fmt, size, quality
+            if key not in self.entries:
+                if size:
+                    image = image.copy()
+                    image.thumbnail((size, size), Image.LANCZOS)
+                buf = io.BytesIO()
+                image.save(buf, format=fmt, **({} if fmt == 'png' else {'quality': quality}))
+                etag = '"%s-%d-%s-%s-%s"' % ((self.token, self.version) + key)
+                self.entries[key] = etag, buf.getvalue()
+            return self.entries[key]
+
+
 class ProgressServer(ThreadingMixIn, HTTPServer):
     """HTTP server class."""
     transfer = None
     progress = None
     hidpi = False
 
+    def __init__(self, server_address, handler_class):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.previews = PreviewCache()
+
+    def status(self):
+        """Returns the progress of the run, the load on each worker during the current scale and
+        since it started, and the memory in use as a JSON-serializable dict. Values which are not
+        known yet are None."""
+        def number(value):
+            return None if value is None or np.isnan(value) else float(value)
+
+        progress, transfer = self.progress, self.transfer
+        status = OrderedDict([
+            ('step', progress.step), ('steps', progress.steps),
+            ('seconds_per_step', number(progress.t)), ('loss', number(progress.loss)),
+            ('update_size', number(progress.update_size)), ('tv_loss', number(progress.tv_loss)),
+            ('scale', transfer.step), ('image_size', None), ('workers', []),
+            ('shm_bytes', None), ('shm_in_use_bytes', None), ('rss_bytes', current_rss()),
+        ])
+        if transfer.current_output is not None:
+            status['image_size'] = list(transfer.current_output.size)
+        pool = transfer.pool
+        if pool is not None:
+            for i, worker in enumerate(pool.workers):
+                status['workers'].append(OrderedDict([
+                    ('worker', i), ('device', worker.device),
+                    ('tiles', int(pool.tile_count[i])), ('busy_seconds', float(pool.busy[i])),
+                    ('tiles_total', int(pool.past_tile_count[i] + pool.tile_count[i])),
+                    ('busy_seconds_total', float(pool.past_busy[i] + pool.busy[i])),
+                    ('tiles_per_second', float(pool.tile_count[i] / max(pool.wall, 1e-9))),
+                    ('rss_bytes', current_rss(worker.proc.pid)),
+                ]))
+            status['shm_bytes'], status['shm_in_use_bytes'] = pool.arena.usage()
+        return status
+
+    def metrics(self):
+        """Returns status() in the Prometheus text exposition format."""
+        status = self.status()
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP style_transfer_%s %s' % (name, doc))
+            lines.append('# TYPE style_transfer_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_str = ','.join('%s="%s"' % item for item in labels)
+                value = 'NaN' if value is None else '%.17g' % value
+                lines.append('style_transfer_%s%s %s' % (
+                    name, '{%s}' % label_str if label_str else '', value))
+
+        # Counters carry the _total suffix, as the Prometheus naming conventions ask
+        metric('steps_total', 'counter', 'Steps completed.', [((), status['step'])])
+        metric('planned_steps', 'gauge', 'Total steps expected in the run.',
+               [((), status['steps'])])
+        metric('seconds_per_step', 'gauge', 'Duration of the last step.',
+               [((), status['seconds_per_step'])])
+        metric('loss', 'gauge', 'Loss at the last step.', [((), status['loss'])])
+        metric('update_size', 'gauge', 'Mean absolute update at the last step.',
+               [((), status['update_size'])])
+        metric('tv_loss', 'gauge', 'Total variation at the last step.', [((), status['tv_loss'])])
+        metric('scale', 'gauge', 'Current scale (1 is the smallest).', [((), status['scale'])])
+        for field, name, kind, doc in (
+                ('tiles_total', 'tiles_total', 'counter',
+                 'Tiles processed by the worker since it started.'),
+                ('busy_seconds_total', 'busy_seconds_total', 'counter',
+                 'Time the worker has been busy since it started.'),
+                ('tiles_per_second', 'tiles_per_second', 'gauge',
+                 'Worker tile throughput in the current scale.'),
+                ('rss_bytes', 'rss_bytes', 'gauge', 'Resident set size of the worker process.')):
+            metric('worker_' + name, kind, doc, [
+                ((('worker', worker['worker']), ('device', worker['device'])), worker[field])
+                for worker in status['workers']])
+        metric('shm_bytes', 'gauge', 'Size of the shared memory arena.',
+               [((), status['shm_bytes'])])
+        metric('shm_in_use_bytes', 'gauge', 'Shared memory arena segments in use.',
+               [((), status['shm_in_use_bytes'])])
+        metric('rss_bytes', 'gauge', 'Resident set size of the master process.',
+               [((), status['rss_bytes'])])
+        return '\n'.join(lines) + '\n'
+
 
 class ProgressHandler(BaseHTTPRequestHandler):
-    """Serves intermediate outputs over HTTP."""
+    """Serves intermediate outputs over HTTP, and the progress of the run as JSON at /status and
+    as Prometheus metrics at /metrics.
+
+    /out.png serves the current output as a PNG. The query parameters format (png, jpeg, or
+    webp), size (the maximum width and height to downscale to), and quality (for JPEG and WebP)
+    select other encodings, e.g. /out.png?format=jpeg&size=512. Responses carry an ETag, and
+    requests with a matching If-None-Match header receive 304 Not Modified."""
     index = """
     <meta http-equiv="refresh" content="5">
     <style>
@@ -1045,7 +2607,8 @@ class ProgressHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         """Retrieves index.html or an intermediate output."""
-        if self.path == '/':
+        url = urlparse(self.path)
+        if url.path == '/':
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
@@ -1062,15 +2625,428 @@ class ProgressHandler(BaseHTTPRequestHandler):
                 'w': self.server.transfer.current_output.size[0] / scale,
                 'h': self.server.transfer.current_output.size[1] / scale,
             }).encode())
-        elif self.path == '/out.png':
+        elif url.path == '/out.png':
+            self.send_preview(parse_qs(url.query))
+        elif url.path == '/status':
+            self.send_body(json.dumps(self.server.status()).encode(), 'application/json')
+        elif url.path == '/metrics':
+            self.send_body(self.server.metrics().encode(), 'text/plain; version=0.0.4')
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type, headers=()):
+        """Sends a 200 response with the given body."""
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_preview(self, query):
+        """Sends the current output, encoded as requested by the query parameters."""
+        fmt = query.get('format', ['png'])[0].lower().replace('jpg', 'jpeg')
+        try:
+            size = int(query['size'][0]) if 'size' in query else None
+            quality = int(query.get('quality', [90])[0])
+        except ValueError:
+            self.send_error(400, 'size and quality must be integers')
+            return
+        if size is not None and size < 1:
+            self.send_error(400, 'size must be positive')
+            return
+        if fmt not in PreviewCache.content_types:
+            self.send_error(400, 'format must be png, jpeg, or webp')
+            return
+        if self.server.transfer.current_output is None:
+            self.send_error(503, 'no output yet')
+            return
+        try:
+            etag, body = self.server.previews.get(self.server.transfer.current_output, fmt,
+                                                  size, quality)
+        except (KeyError, IOError, ValueError) as err:
+            self.send_error(400, 'cannot encode %s: %s' % (fmt, err))
+            return
+        headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            return
+        self.send_body(body, PreviewCache.content_types[fmt], headers)
+
+
+def scale_sizes():
+    """Returns the image sizes of the scales processed by transfer_multiscale(), largest
+    first."""
+    size = ARGS.size
+    sizes = [ARGS.size]
+    while True:
+        size = round(size / np.sqrt(2))
+        if size < ARGS.min_size:
+            break
+        sizes.append(size)
+    return sizes
+
+
+class Job:
+    """A style transfer job submitted to a JobServer."""
+    def __init__(self, job_id, args, content_image, style_images, initial_image=None):
+        self.id = job_id
+        self.args = args
+        self.content_image = content_image
+        self.style_images = style_images
+        self.initial_image = initial_image
+        self.state = 'queued'
+        self.error = None
+        self.progress = None
+        self.step, self.steps, self.scales = None, None, None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def status(self):
+        """Returns the job's status as a JSON-serializable dict."""
+        status = OrderedDict([('id', self.id), ('state', self.state), ('error', self.error)])
+        progress = self.progress
+        if progress:
+            status['step'] = progress.step
+            status['steps'] = progress.steps
+            status['scales'] = progress.transfer.scales
+        elif self.step is not None:
+            status['step'], status['steps'], status['scales'] = self.step, self.steps, self.scales
+        for field in ('submitted', 'started', 'finished'):
+            status[field] = getattr(self, field)
+        return status
+
+
+class JobServer(ThreadingMixIn, HTTPServer):
+    """HTTP server class which runs style transfer jobs one at a time on a single, persistent
+    TileWorkerPool, so that only the first job pays for process startup and weight loading. Only
+    the keep_jobs most recently finished jobs (and their results) are kept."""
+    def __init__(self, server_address, model, args, keep_jobs=100):
+        HTTPServer.__init__(self, server_address, JobHandler)
+        self.model = model
+        self.args = args
+        self.keep_jobs = keep_jobs
+        self.job_count = 0
+        self.pool = None
+        self.jobs = OrderedDict()
+        self.job_q = queue.Queue()
+        self.lock = threading.Lock()
+
+    def submit(self, argv, content_image, style_images, initial_image=None):
+        """Queues a job, given per-job command line arguments, and returns it."""
+        args = parse_job_args(argv, self.args)
+        with self.lock:
+            self.job_count += 1
+            job = Job(self.job_count, args, content_image, style_images, initial_image)
+            self.jobs[job.id] = job
+        self.job_q.put(job)
+        return job
+
+    def run_jobs(self):
+        """Runs queued jobs forever. To be run in a separate thread."""
+        global ARGS  # pylint: disable=global-statement
+        transfer = StyleTransfer(self.model)
+        transfer.start_pool()
+        self.pool = transfer.pool
+        while True:
+            job = self.job_q.get()
+            job.state, job.started = 'running', time.time()
+            print_('\nStarting job %d.' % job.id)
+            ARGS = job.args
+            try:
+                transfer = StyleTransfer(self.model)
+                transfer.pool = self.pool
+                transfer.start_pool()
+                self.pool = transfer.pool
+                job.progress = Progress(transfer, save_every=ARGS.save_every)
+                np.random.seed(ARGS.seed)
+                transfer.transfer_multiscale(
+                    [job.content_image], job.style_images, job.initial_image, None, [], [],
+                    callback=job.progress)
+                buf = io.BytesIO()
+                transfer.current_output.save(buf, format='png')
+                job.result = buf.getvalue()
+                job.state = 'done'
+            except Exception as err:  # pylint: disable=broad-except
+                job.state, job.error = 'failed', '%s: %s' % (type(err).__name__, err)
+                print_('Job %d failed: %s' % (job.id, job.error))
+            finally:
+                ARGS = self.args
+                job.content_image = job.style_images = job.initial_image = None
+                if job.progress:
+                    # Keep only the final counts: the Progress holds the whole StyleTransfer,
+                    # including its optimizer state and workspaces.
+                    job.step, job.steps = job.progress.step, job.progress.steps
+                    job.scales = job.progress.transfer.scales
+                    job.progress = None
+                job.finished = time.time()
+            print_('Finished job %d in %.2f s.' % (job.id, job.finished - job.started))
+            self.forget_finished_jobs()
+
+    def forget_finished_jobs(self):
+        """Removes the least recently finished jobs beyond the first keep_jobs."""
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.finished is not None),
+                              key=lambda job: job.finished)
+            for job in finished[:max(0, len(finished) - self.keep_jobs)]:
+                del self.jobs[job.id]
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """Accepts style transfer jobs and serves their status and results over HTTP.
+
+    POST /jobs with a JSON object containing 'content' (a base64-encoded image file), 'styles' (a
+    list of them), and optionally 'init' (an initial image) and 'args' (a list of command line
+    arguments, e.g. ["--size", "1024"]) queues a job and returns its status. GET /jobs lists the
+    status of all jobs, GET /jobs/<id> returns one job's status, and GET /jobs/<id>/result returns
+    its output as a PNG once its state is 'done'."""
+
+    def send_json(self, obj, code=200):
+        """Sends a JSON response."""
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, job_id):
+        """Returns the job with the given id (as a string), or None."""
+        try:
+            return self.server.jobs.get(int(job_id))
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        """Retrieves the status or the output of jobs."""
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            with self.server.lock:
+                jobs = list(self.server.jobs.values())
+            self.send_json([job.status() for job in jobs])
+            return
+        job = self.get_job(parts[1]) if len(parts) in (2, 3) and parts[0] == 'jobs' else None
+        if job is None:
+            self.send_error(404)
+        elif len(parts) == 2:
+            self.send_json(job.status())
+        elif parts[2] != 'result':
+            self.send_error(404)
+        elif job.state != 'done':
+            self.send_json(job.status(), code=409)
+        else:
             self.send_response(200)
             self.send_header('Content-type', 'image/png')
+            self.send_header('Content-length', str(len(job.result)))
             self.end_headers()
-            buf = io.BytesIO()
-            self.server.transfer.current_output.save(buf, format='png')
-            self.wfile.write(buf.getvalue())
-        else:
+            self.wfile.write(job.result)
+
+    def do_POST(self):
+        """Submits a job."""
+        if self.path.rstrip('/') != '/jobs':
             self.send_error(404)
+            return
+
+        def load_image(data):
+            return Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB')
+
+        try:
+            length = int(self.headers.get('Content-length', 0))
+            req = json.loads(self.rfile.read(length).decode())
+            content_image = load_image(req['content'])
+            style_images = [load_image(data) for data in req['styles']]
+            initial_image = load_image(req['init']) if req.get('init') else None
+            job = self.server.submit(req.get('args', []), content_image, style_images,
+                                     initial_image)
+        except (KeyError, TypeError, ValueError, IOError, SystemExit) as err:
+            self.send_json({'error': '%s: %s' % (type(err).__name__, err)}, code=400)
+            return
+        self.send_json(job.status(), code=202)
+
+
+def run_batch(model, manifest):
+    """Stylizes each row of a JSONL manifest in turn, reusing the worker pool, loaded style images,
+    and style Gram matrices between rows. Each row is a JSON object with the keys 'content',
+    'style' (one or more comma-separated paths), 'output', and optionally 'overrides' (command
+    line arguments, as a list or a dict of long option names to values; see parse_job_args()).
+    Returns the number of rows which failed."""
+    global ARGS  # pylint: disable=global-statement
+    batch_args = ARGS
+    with open(manifest) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    transfer = StyleTransfer(model)
+    transfer.start_pool()
+    pool = transfer.pool
+    memory_cache = MemoryStyleCache()
+    style_images = {}
+    batch_start = timer()
+    succeeded = 0
+
+    for i, row in enumerate(rows):
+        row_start = timer()
+        print_('\nBatch row %d/%d: %s -> %s' % (i+1, len(rows), row.get('content'),
+                                                row.get('output')))
+        try:
+            ARGS = parse_job_args(row.get('overrides', []), batch_args)
+            transfer = StyleTransfer(model)
+            transfer.pool = pool
+            transfer.start_pool()
+            pool = transfer.pool
+            if transfer.style_cache is None:
+                memory_cache.style_scale = ARGS.style_scale
+                transfer.style_cache = memory_cache
+            content_image = Image.open(row['content']).convert('RGB')
+            styles = []
+            for path in row['style'].split(','):
+                if path not in style_images:
+                    style_images[path] = StylePack(path) if StylePack.is_pack(path) else \
+                        Image.open(path).convert('RGB')
+                if isinstance(style_images[path], StylePack):
+                    # The row's overrides may not match the pack
+                    style_images[path].check(model)
+                styles.append(style_images[path])
+            np.random.seed(ARGS.seed)
+            transfer.transfer_multiscale(
+                [content_image], styles, None, None, [], [],
+                callback=Progress(transfer, save_every=ARGS.save_every))
+            save_output(transfer, row['output'])
+            succeeded += 1
+        except Exception as err:  # pylint: disable=broad-except
+            print_('Batch row %d failed: %s: %s' % (i+1, type(err).__name__, err))
+            print_('Batch row %d took %.2f s.' % (i+1, timer() - row_start), flush=True)
+            continue
+        finally:
+            ARGS = batch_args
+        row_time = timer() - row_start
+        print_('Batch row %d took %.2f s (%.1f images/hour).' %
+               (i+1, row_time, 3600 / row_time), flush=True)
+
+    batch_time = timer() - batch_start
+    print_('\nBatch: %d/%d rows succeeded in %.2f s (%.1f images/hour).' %
+           (succeeded, len(rows), batch_time, 3600 * succeeded / batch_time))
+    if memory_cache.hits or memory_cache.misses:
+        print_(memory_cache.stats())
+    pool.reset_arena()
+    return len(rows) - succeeded
+
+
+def run_sequence(model, input_dir, output_dir):
+    """Stylizes the frames in input_dir in name order, writing each output to output_dir as soon as
+    it is done. The first frame is stylized from scratch. Each later frame starts from the previous
+    frame's optimizer state (or output image, with --sequence-init output) and only runs the
+    --sequence-scales finest scales for --sequence-iterations steps. The worker pool and style
+    Gram matrices are shared by all frames. Frames whose outputs already exist are skipped, and
+    their outputs are used to warm start the following frame."""
+    global ARGS  # pylint: disable=global-statement
+    seq_args = ARGS
+    exts = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+    frames = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(exts))
+    os.makedirs(output_dir, exist_ok=True)
+    transfer = StyleTransfer(model)
+    if transfer.style_cache is None:
+        transfer.style_cache = MemoryStyleCache(style_scale=ARGS.style_scale)
+    style_images = load_style_images(model, ARGS.style_images.split(','))
+    prev_output, prev_state = None, None
+    seq_start = timer()
+    done = 0
+    np.random.seed(ARGS.seed)
+
+    try:
+        for i, frame in enumerate(frames):
+            output = os.path.join(output_dir, os.path.splitext(frame)[0] + '.png')
+            if os.path.exists(output):
+                print_('\nFrame %d/%d: %s exists, skipping.' % (i+1, len(frames), output))
+                prev_output, prev_state = Image.open(output).convert('RGB'), None
+                continue
+            frame_start = timer()
+            print_('\nFrame %d/%d: %s -> %s' % (i+1, len(frames), frame, output))
+            content_image = Image.open(os.path.join(input_dir, frame)).convert('RGB')
+            initial_image, initial_state, scales = None, None, None
+            if prev_output is not None:
+                ARGS = copy.copy(seq_args)
+                ARGS.iterations = [ARGS.sequence_iterations]
+                scales = ARGS.sequence_scales
+                if prev_state is not None and ARGS.sequence_init == 'state':
+                    initial_state = prev_state
+                else:
+                    initial_image = prev_output
+            transfer.transfer_multiscale(
+                [content_image], style_images, initial_image, None, [], [],
+                initial_state=initial_state, scales=scales,
+                callback=Progress(transfer, save_every=ARGS.save_every))
+            ARGS = seq_args
+            save_output(transfer, output, state=False)
+            prev_output, prev_state = transfer.current_output, transfer.optimizer
+            if isinstance(prev_state, LBFGSOptimizer):
+                # Curvature pairs from this frame's objective would mix with the next frame's
+                prev_state.pairs, prev_state.direction = [], None
+                prev_state.last_step, prev_state.last_grad = None, None
+            done += 1
+            frame_time = timer() - frame_start
+            print_('Frame %d took %.2f s (%.1f frames/minute overall).' %
+                   (i+1, frame_time, 60 * done / (timer() - seq_start)), flush=True)
+    finally:
+        ARGS = seq_args
+        if transfer.pool:
+            transfer.pool.reset_arena()
+
+    seq_time = timer() - seq_start
+    print_('\nSequence: %d frame(s) in %.2f s (%.1f frames/minute).' %
+           (done, seq_time, 60 * done / seq_time))
+    print_(transfer.style_cache.stats())
+
+
+def load_style_images(model, filenames):
+    """Loads style images and style packs. Exits with an error if a style pack was made with
+    settings which do not match the run's, or lacks any of the sizes the run needs, before any
+    work is done."""
+    style_images = []
+    for filename in filenames:
+        if StylePack.is_pack(filename):
+            pack = StylePack(filename)
+            try:
+                pack.check(model)
+            except ValueError as err:
+                print_('Error: %s' % err, file=sys.stderr)
+                sys.exit(1)
+            style_images.append(pack)
+        else:
+            style_images.append(Image.open(filename).convert('RGB'))
+    return style_images
+
+
+def save_output(transfer, filename, state=True):
+    """Saves the current output image, with the parameters in a PNG comment, and (if state is
+    True) the optimizer state alongside it."""
+    print_('Saving output as %s.' % filename)
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_itxt('Comment', get_image_comment())
+    transfer.current_output.save(filename, pnginfo=png_info)
+    if state:
+        a, _, _ = filename.rpartition('.')
+        print_('Saving state as %s.' % (a + '.state'))
+        transfer.save_state(a + '.state')
+
+
+def serve_jobs(model):
+    """Runs a JobServer on the port given by --port until interrupted."""
+    server = JobServer((ARGS.host, ARGS.port), model, ARGS, ARGS.keep_jobs)
+    th = threading.Thread(target=server.run_jobs)
+    th.daemon = True
+    th.start()
+    print_('\nAccepting jobs at: http://%s:%d/jobs\n' % (ARGS.host or '0.0.0.0', ARGS.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print_()
+    if server.pool:
+        server.pool.reset_arena()
 
 
 def resize_to_fit(image, size, scale_up=False):
@@ -1094,20 +3070,38 @@ def ffloat(s):
     return float(Fraction(s))
 
 
-def parse_args():
-    """Parses command line arguments. Alternate default arguments are read from style_transfer.ini
-    (an alternate config can be specified by --config). The .ini file should begin with the
-    line [DEFAULT] and contain keys corresponding to the long option names."""
-    config_file = 'style_transfer.ini'
+def tile_batch_size(s):
+    """Parses a batch size, which is a positive integer or 'auto'."""
+    if s == 'auto':
+        return s
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError('batch size must be at least 1')
+    return value
 
+
+def positive_int(s):
+    """Parses an integer which must be at least 1."""
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
+def make_parser(config_file='style_transfer.ini', add_help=True):
+    """Returns the command line argument parser."""
     parser = argparse.ArgumentParser(
-        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        add_help=add_help)
     parser.add_argument('content_image', nargs='?', default=None, help='the content image')
     parser.add_argument('style_images', nargs='?', default=None, help='the style images')
     parser.add_argument('output_image', nargs='?', default='out.png', help='the output image')
     parser.add_argument('--config', default=config_file,
                         help='an ini file containing values for command line arguments')
     parser.add_argument('--list-layers', action='store_true', help='list the model\'s layers')
+    parser.add_argument(
+        '--make-style-pack', nargs=2, metavar=('STYLE_IMAGE', 'PACK'),
+        help='precompute a style pack for every scale, usable in place of a style image')
     parser.add_argument('--caffe-path', help='the path to the Caffe installation')
     parser.add_argument('--init-image', metavar='IMAGE', help='the initial image')
     parser.add_argument('--aux-image', metavar='IMAGE', help='the auxiliary image')
@@ -1129,6 +3123,15 @@ def parse_args():
     parser.add_argument(
         '--step-size', '-st', type=ffloat, default=15,
         help='the Adam step size (iteration magnitude)')
+    parser.add_argument(
+        '--optimizer', default='adam', choices=['adam', 'lbfgs'],
+        help='the optimizer: Adam, or L-BFGS, which can take fewer gradient evaluations')
+    parser.add_argument(
+        '--lbfgs-history', type=positive_int, default=5, metavar='N',
+        help='the number of curvature pairs kept by L-BFGS (each is twice the image size)')
+    parser.add_argument(
+        '--lbfgs-step-size', type=ffloat, default=5,
+        help='the maximum mean L-BFGS step size (iteration magnitude)')
     parser.add_argument(
         '--avg-window', type=ffloat, default=20, help='the iterate averaging window size')
     parser.add_argument(
@@ -1181,8 +3184,89 @@ def parse_args():
         help='device numbers to use (-1 for cpu)')
     parser.add_argument(
         '--tile-size', type=int, default=512, help='the maximum rendering tile size')
+    parser.add_argument(
+        '--timeline', metavar='FILE',
+        help='write the start and end of each phase of every step of the master to FILE, as CSV')
+    parser.add_argument(
+        '--phase-log', metavar='FILE',
+        help='write the time spent in each phase of every step by the master and the workers to '
+        'FILE, as JSON lines')
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help='write a Chrome trace (for chrome://tracing or Perfetto) of the master and worker '
+        'timelines to FILE')
+    parser.add_argument(
+        '--no-fast-path', action='store_true',
+        help='send every tile through the worker queues, even when the image fits in one tile')
+    parser.add_argument(
+        '--tile-batch', type=tile_batch_size, default=1, metavar='N',
+        help='the number of equal-shaped tiles to evaluate per forward/backward pass, or auto')
     parser.add_argument(
         '--seed', type=int, default=0, help='the random seed')
+    parser.add_argument(
+        '--stop-threshold', type=ffloat, default=0,
+        help='end a scale early once the smoothed loss stops improving by this relative amount '
+        '(0 to disable)')
+    parser.add_argument(
+        '--stop-patience', type=int, default=10, metavar='STEPS',
+        help='the number of steps without improvement after which a scale ends early')
+    parser.add_argument(
+        '--stop-min-steps', type=int, default=20, metavar='STEPS',
+        help='the minimum number of steps per scale when ending scales early')
+    parser.add_argument(
+        '--stop-max-steps', type=int, metavar='STEPS',
+        help='the maximum number of steps per scale, including carried steps')
+    parser.add_argument(
+        '--time-budget', type=ffloat, metavar='SECONDS',
+        help='fit the job into a wall-clock time budget, running as many steps at each scale as '
+        'its share of the budget allows instead of a fixed number of iterations')
+    parser.add_argument(
+        '--carry-steps', action='store_true',
+        help='add the steps left unused by scales which end early to the next scale')
+    parser.add_argument(
+        '--stream-style-grams', action='store_true',
+        help='compute style Gram matrices from per-tile partial sums (averaged over passes), so '
+        'that style preprocessing memory does not depend on the style image size')
+    parser.add_argument(
+        '--style-cache', metavar='DIR',
+        help='a directory in which to cache style Gram matrices between runs')
+    parser.add_argument(
+        '--style-cache-size', metavar='MB', type=int, default=1024,
+        help='the maximum size of the style cache')
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='run a job server on --port which keeps the model loaded between jobs')
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='the address on which the job server listens (0.0.0.0 for all interfaces)')
+    parser.add_argument(
+        '--keep-jobs', type=int, default=100, metavar='N',
+        help='the number of finished jobs whose status and result the job server keeps')
+    parser.add_argument(
+        '--batch', metavar='MANIFEST',
+        help='stylize each row of a JSONL manifest of content, style, output, and overrides')
+    parser.add_argument(
+        '--sequence', nargs=2, metavar=('INPUT_DIR', 'OUTPUT_DIR'),
+        help='stylize the frames in INPUT_DIR into OUTPUT_DIR, warm starting each frame from the '
+        'previous one; the style images are given as the only positional argument')
+    parser.add_argument(
+        '--sequence-init', default='state', choices=['state', 'output'],
+        help='warm start frames from the previous frame\'s optimizer state or output image')
+    parser.add_argument(
+        '--sequence-scales', type=int, default=1, metavar='N',
+        help='the number of finest scales to run for warm started frames')
+    parser.add_argument(
+        '--sequence-iterations', type=int, default=50, metavar='N',
+        help='the number of iterations per scale for warm started frames')
+    return parser
+
+
+def parse_args():
+    """Parses command line arguments. Alternate default arguments are read from style_transfer.ini
+    (an alternate config can be specified by --config). The .ini file should begin with the
+    line [DEFAULT] and contain keys corresponding to the long option names."""
+    config_file = 'style_transfer.ini'
+    parser = make_parser(config_file)
 
     global ARGS  # pylint: disable=global-statement
     args_from_cli = parser.parse_args()
@@ -1197,9 +3281,59 @@ def parse_args():
     config_parsed = parser.parse_args(args=config_args)
     new_defaults = {arg: getattr(config_parsed, arg) for arg in config['DEFAULT']}
     ARGS = parser.parse_args(namespace=argparse.Namespace(**new_defaults))
-    if not ARGS.list_layers and (ARGS.content_image is None or ARGS.style_images is None):
+    if not (ARGS.list_layers or ARGS.make_style_pack or ARGS.serve or ARGS.batch) and \
+       (ARGS.content_image is None or ARGS.style_images is None) and \
+       not (ARGS.sequence and ARGS.content_image):
         parser.print_help()
         sys.exit(1)
+    if ARGS.sequence and ARGS.style_images is None:
+        # The only positional argument names the style images
+        ARGS.content_image, ARGS.style_images = None, ARGS.content_image
+
+
+# The options which a job server job or a batch row may set. Everything else (file paths, the
+# model, the devices, and the run mode) is fixed by the server's or batch's own command line.
+JOB_ARGS = (
+    'iterations', 'size', 'min_size', 'style_scale', 'style_scale_up', 'step_size', 'optimizer',
+    'lbfgs_history', 'lbfgs_step_size', 'avg_window', 'content_weight', 'dd_weight', 'tv_weight',
+    'tv_power', 'p_weight', 'p_power', 'aux_weight', 'content_layers', 'style_layers',
+    'dd_layers', 'tile_size', 'tile_batch', 'no_fast_path', 'seed', 'stop_threshold',
+    'stop_patience', 'stop_min_steps', 'stop_max_steps', 'time_budget', 'carry_steps',
+    'stream_style_grams')
+
+
+def parse_job_args(argv, base_args):
+    """Parses command line arguments for a single job, using base_args (the server's or batch's
+    own arguments) as the defaults, and returns the result. argv may be a list of arguments or
+    a dict mapping long option names to values. Raises ValueError for invalid arguments and for
+    arguments which are not in JOB_ARGS."""
+    def error(message):
+        raise ValueError(message)
+
+    def exit_(status=0, message=None):
+        raise ValueError(message or 'exited with status %d' % status)
+
+    if isinstance(argv, dict):
+        argv_dict, argv = argv, []
+        for name, value in argv_dict.items():
+            if value is False or value is None:
+                continue
+            argv.append('--' + name.replace('_', '-'))
+            if value is not True:
+                argv.extend(value if isinstance(value, list) else [value])
+    parser = make_parser(add_help=False)
+    parser.error, parser.exit = error, exit_
+    # Parse without defaults, so that only the arguments actually given are set
+    for action in parser._actions:  # pylint: disable=protected-access
+        action.default = argparse.SUPPRESS
+    given = vars(parser.parse_args([str(arg) for arg in argv]))
+    for arg in sorted(given):
+        if arg not in JOB_ARGS:
+            raise ValueError('%s cannot be set per job' % (
+                arg if arg.endswith('image') else '--' + arg.replace('_', '-')))
+    args = copy.copy(base_args)
+    vars(args).update(given)
+    return args
 
 
 def print_args():
@@ -1233,6 +3367,16 @@ def init_model(resp_q, net_type):
     resp_q.put(shapes)
 
 
+def load_model():
+    """Returns a placeholder CaffeModel for ARGS.model, whose layer shapes are read in a separate
+    process so that Caffe is not initialized in this one."""
+    print_('Loading %s.' % ARGS.weights)
+    resp_q = CTX.Queue()
+    CTX.Process(target=init_model, args=(resp_q, None)).start()
+    shapes = resp_q.get()
+    return CaffeModel(ARGS.model, ARGS.weights, ARGS.mean, None, shapes=shapes, placeholder=True)
+
+
 def main():
     """CLI interface for style transfer."""
     start_time = timer()
@@ -1246,23 +3390,29 @@ def main():
     if ARGS.caffe_path:
         sys.path.append(ARGS.caffe_path + '/python')
 
-    print_('Loading %s.' % ARGS.weights)
-    resp_q = CTX.Queue()
-    CTX.Process(target=init_model, args=(resp_q, None)).start()
-    shapes = resp_q.get()
-    model = CaffeModel(ARGS.model, ARGS.weights, ARGS.mean, None, shapes=shapes,
-                       placeholder=True)
+    model = load_model()
     transfer = StyleTransfer(model)
     if ARGS.list_layers:
         print_('Layers:')
         for layer, shape in model.shapes.items():
             print_('% 25s %s' % (layer, shape))
         sys.exit(0)
+    if ARGS.make_style_pack:
+        style_image, pack = ARGS.make_style_pack
+        transfer.make_style_pack(Image.open(style_image).convert('RGB'), pack)
+        print_('Wrote style pack %s.' % pack)
+        sys.exit(0)
+    if ARGS.serve:
+        serve_jobs(model)
+        sys.exit(0)
+    if ARGS.batch:
+        sys.exit(1 if run_batch(model, ARGS.batch) else 0)
+    if ARGS.sequence:
+        run_sequence(model, *ARGS.sequence)
+        sys.exit(0)
 
     content_image = Image.open(ARGS.content_image).convert('RGB')
-    style_images, style_masks = [], []
-    for image in ARGS.style_images.split(','):
-        style_images.append(Image.open(image).convert('RGB'))
+    style_images, style_masks = load_style_images(model, ARGS.style_images.split(',')), []
     initial_image, aux_image = None, None
     if ARGS.init_image:
         initial_image = Image.open(ARGS.init_image).convert('RGB')
@@ -1298,15 +3448,11 @@ def main():
             callback=server.progress, initial_state=state)
     except KeyboardInterrupt:
         print_()
+        if transfer.pool:
+            transfer.pool.reset_arena()
 
     if transfer.current_output:
-        print_('Saving output as %s.' % ARGS.output_image)
-        png_info = PngImagePlugin.PngInfo()
-        png_info.add_itxt('Comment', get_image_comment())
-        transfer.current_output.save(ARGS.output_image, pnginfo=png_info)
-        a, _, _ = ARGS.output_image.rpartition('.')
-        print_('Saving state as %s.' % (a + '.state'))
-        transfer.save_state(a + '.state')
+        save_output(transfer, ARGS.output_image)
     time_spent = timer() - start_time
     print_('Exiting after %dm %.2fs.' % (time_spent // 60, time_spent % 60))
 
@@ -0,0 +1,311 @@
+"""Tests for style_transfer.py which do not require Caffe. Run with pytest."""
+
+from collections import OrderedDict
+import http.client
+import json
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+import pytest
+
+import style_transfer
+from style_transfer import (AdamOptimizer, CaffeModel, EarlyStopping, EPS, gram_matrix,
+                            LBFGSOptimizer, make_parser, MemoryStyleCache, parse_job_args,
+                            PreviewCache, ProgressHandler, ProgressServer, Regularizers, roll2,
+                            roll2_index, roll2_window, StyleCache, StylePack, tile_bounds,
+                            tv_norm)
+
+
+def test_early_stopping_flat_loss_stops():
+    """A flat loss ends the scale even though the update size keeps shrinking."""
+    stopping = EarlyStopping(0.01, patience=10, min_steps=20)
+    for step in range(1, 101):
+        if stopping.update(1000 * (1 + 0.5 ** step)):
+            break
+    assert step < 100
+
+
+def test_early_stopping_falling_loss_continues():
+    """A loss which keeps falling by more than the threshold does not end the scale."""
+    stopping = EarlyStopping(0.01, patience=10, min_steps=20)
+    assert not any(stopping.update(1000 * 0.9 ** step) for step in range(100))
+
+
+def test_early_stopping_negative_loss():
+    """Progress is measured relative to the magnitude of the best loss, which may be negative."""
+    stopping = EarlyStopping(0.01, patience=10, min_steps=20)
+    assert not any(stopping.update(-1000 * 1.1 ** step) for step in range(100))
+
+
+def placeholder_model(tmpdir):
+    """Returns a CaffeModel without a network, with two small layers and dummy model files."""
+    deploy, weights = tmpdir.join('deploy.prototxt'), tmpdir.join('weights.caffemodel')
+    deploy.write('deploy')
+    weights.write('weights')
+    shapes = OrderedDict([('conv1_1', (4, 224, 224)), ('pool1', (4, 112, 112))])
+    return CaffeModel(str(deploy), str(weights), shapes=shapes, placeholder=True)
+
+
+class FakeFeatures:
+    """Stands in for CaffeModel.prepare_features_many(), returning random feature maps (or their
+    Gram matrices) and recording the sizes of the images it was given."""
+    def __init__(self, model):
+        self.model = model
+        self.sizes = []
+
+    def __call__(self, pool, images, layers, tile_size=512, passes=10, grams=None):
+        results = []
+        for img, img_layers, as_grams in zip(images, layers, grams):
+            self.sizes.append(img.shape[-2:])
+            feats = {}
+            for layer in img_layers:
+                scale, ch = self.model.layer_info(layer)
+                feat = np.float32(np.random.rand(ch, *(-(-np.array(img.shape[-2:]) // scale))))
+                feats[layer] = gram_matrix(feat) if as_grams else feat
+            results.append(feats)
+        return results
+
+
+def test_style_pack_round_trip(tmpdir):
+    """Gram matrices read back from a style pack match those written, for many header lengths."""
+    model = placeholder_model(tmpdir)
+    rng = np.random.RandomState(0)
+    grams = {'conv1_1': rng.rand(3, 3).astype(np.float32),
+             'conv2_1': rng.rand(5, 5).astype(np.float32)}
+    filename = str(tmpdir.join('style.pak'))
+    for pad in range(StylePack.align * 3):
+        header = StylePack.header_for(model, (8, 6), list(grams), 512, 1)
+        header['note'] = 'x' * pad
+        StylePack.write(filename, header, {(8, 6): grams, (4, 3): grams})
+        pack = StylePack(filename)
+        assert pack.header['data_start'] % StylePack.align == 0
+        for size in (8, 6), (4, 3):
+            read = pack.resize(size).grams(model, list(grams), 512, 1)
+            for layer, gram in grams.items():
+                assert np.array_equal(read[layer], gram)
+
+
+def test_roll2_window_matches_roll2():
+    """Windows of a virtually rolled array match the same windows of the physically rolled one,
+    including windows which wrap around the edges and windows clipped to the array bounds."""
+    arr = np.arange(2 * 7 * 9, dtype=np.float32).reshape((2, 7, 9))
+    for xy in np.array([0, 0]), np.array([3, -2]), np.array([-8, 6]), np.array([4, 1]):
+        rolled = roll2(arr, xy)
+        for start, end in ((0, 0), (7, 9)), ((2, 3), (5, 8)), ((4, 6), (10, 12)):
+            start, end = np.array(start), np.array(end)
+            expected = rolled[:, start[0]:end[0], start[1]:end[1]]
+            assert np.array_equal(roll2_window(arr, xy, start, end), expected)
+            assert np.array_equal(arr[roll2_index(arr.shape, xy, start, end)], expected)
+
+
+def test_roll2_window_is_view_unless_wrapping():
+    """An unwrapped window is a view of the array, so tiles can be written through it."""
+    arr = np.zeros((1, 8, 8), np.float32)
+    window = roll2_window(arr, np.array([1, 1]), np.array([2, 2]), np.array([4, 4]))
+    window[:] = 1
+    assert arr.sum() == 4
+
+
+def test_tile_bounds_cover_image():
+    """The tiles cover the image exactly once and are no larger than the tile size."""
+    for img_size, tile_size in ((100, 130), 64), ((64, 64), 64), ((65, 200), 64):
+        covered = np.zeros(img_size, np.int32)
+        for start, end in tile_bounds(img_size, tile_size):
+            assert ((end - start) <= tile_size).all()
+            covered[start[0]:end[0], start[1]:end[1]] += 1
+        assert (covered == 1).all()
+
+
+def test_regularizers_match_reference():
+    """The in-place banded regularizers match tv_norm() and the p-norm with full-size
+    temporaries, for both the quadratic and the general TV power."""
+    mean = np.float32((103.939, 116.779, 123.68)).reshape((3, 1, 1))
+    rng = np.random.RandomState(0)
+    img = np.float32(rng.uniform(-127, 127, (3, 37, 29)))
+    roll = np.array([5, -11])
+    regularizers = Regularizers(img.shape, mean, threads=3)
+    regularizers.bands.bands = [(0, 10), (10, 11), (11, 30), (30, 37)]
+    h, w = img.shape[-2:]
+    for tv_power, p_power in (2, 6), (1.5, 4):
+        tv_loss, tv_grad = tv_norm(img / 255, beta=tv_power)
+        tv_mask = np.ones_like(tv_grad)
+        tv_mask[:, (np.array([0, 1, h-2, h-1]) - roll[1]) % h, :] = 5
+        tv_mask[:, :, (np.array([0, 1, w-2, w-1]) - roll[0]) % w] = 5
+        img_scaled = abs((img + mean - 127.5) / 127.5)
+        img_pow = img_scaled**(p_power-1)
+        ref_loss = tv_loss + 0.05 * np.sum(img_pow * img_scaled)
+        ref_grad = tv_grad * tv_mask + 0.05 * p_power * np.sign(img) * img_pow
+
+        loss, grad = regularizers(img, roll, 1, tv_power, 0.05, p_power)
+        assert abs(loss - ref_loss) <= 1e-4 * abs(ref_loss)
+        assert np.max(abs(grad - ref_grad)) <= 1e-4 * np.max(abs(ref_grad))
+
+
+def test_adam_update_matches_reference():
+    """The in-place Adam update matches the textbook update, including the iterate average."""
+    rng = np.random.RandomState(0)
+    img = np.float32(rng.uniform(-127, 127, (3, 17, 13)))
+    opt = AdamOptimizer(img.copy(), step_size=15, bp1=0.95)
+    params, g1, g2, p1 = img.astype(np.float64), 0, 0, 0
+    for step in range(1, 4):
+        grad = np.float32(rng.normal(size=img.shape))
+        g1 = 0.9 * g1 + 0.1 * grad
+        g2 = 0.999 * g2 + 0.001 * grad**2
+        step_size = 15 * np.sqrt(1 - 0.999**step) / (1 - 0.9**step)
+        params = params - step_size * g1 / (np.sqrt(g2) + EPS)
+        p1 = 0.95 * p1 + 0.05 * params
+        avg, _ = opt.update(lambda _, grad=grad: (0, grad))
+        assert np.allclose(opt.params, params, rtol=1e-5, atol=1e-3)
+        assert np.allclose(avg, p1 / (1 - 0.95**step), rtol=1e-5, atol=1e-3)
+
+
+def test_preview_cache_etags():
+    """Previews are encoded once per image and key, and their ETags change with the image."""
+    cache = PreviewCache()
+    image = Image.new('RGB', (40, 30), (200, 100, 50))
+    etag, body = cache.get(image)
+    assert cache.get(image) == (etag, body)
+    assert cache.get(image, size=40) == (etag, body)
+    assert cache.get(image, 'jpeg', quality=500) == cache.get(image, 'jpeg', quality=100)
+    assert cache.get(image, 'jpeg')[0] != etag
+    assert cache.get(image.copy())[0] != etag
+
+
+def test_progress_server_if_none_match():
+    """/out.png answers 304 Not Modified to a matching If-None-Match, and 200 otherwise."""
+    server = ProgressServer(('127.0.0.1', 0), ProgressHandler)
+    server.transfer = SimpleNamespace(current_output=Image.new('RGB', (40, 30)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        def get(headers):
+            conn = http.client.HTTPConnection(*server.server_address)
+            conn.request('GET', '/out.png?format=jpeg&size=20', headers=headers)
+            resp = conn.getresponse()
+            result = resp.status, resp.getheader('ETag'), resp.read()
+            conn.close()
+            return result
+
+        status, etag, body = get({})
+        assert status == 200 and etag and body
+        assert get({'If-None-Match': '"other", ' + etag})[:2] == (304, etag)
+        server.transfer.current_output = Image.new('RGB', (40, 30))
+        status, new_etag, _ = get({'If-None-Match': etag})
+        assert status == 200 and new_etag != etag
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_parse_job_args_allowlist():
+    """Per-job arguments may only set the options in JOB_ARGS, given as a list or a dict, and
+    leave the base arguments unchanged."""
+    base = make_parser().parse_args(['content.png', 'style.png'])
+    args = parse_job_args(['--size', '384', '--iterations', '10', '5'], base)
+    assert args.size == 384 and args.iterations == [10, 5]
+    args = parse_job_args({'size': 384, 'no_fast_path': True, 'seed': None}, base)
+    assert args.size == 384 and args.no_fast_path and args.seed == base.seed
+    assert base.size != 384 and base.devices == args.devices
+    for argv in ['--devices', '1'], ['--layer-weights', 'weights.json'], ['other.png'], \
+            ['--size', 'large'], {'style_cache': 'cache'}:
+        with pytest.raises(ValueError):
+            parse_job_args(argv, base)
+
+
+def test_style_cache_hits_across_content_sizes(tmpdir):
+    """A style image's cached Gram matrices are reused with content images of other sizes, and
+    its layer masks are recomputed for each content size."""
+    model = placeholder_model(tmpdir)
+    model.prepare_features_many = fake = FakeFeatures(model)
+    style = Image.new('RGB', (24, 20), (10, 200, 30))
+    for cache in StyleCache(str(tmpdir.join('cache')), 2**20), MemoryStyleCache():
+        for content_size in (32, 16), (40, 48):
+            content = Image.new('RGB', content_size)
+            mask = np.ones(content_size[::-1], np.float32)
+            model.contents, model.styles, fake.sizes = [], [], []
+            model.preprocess_images(None, [content], [style], ['conv1_1'], ['conv1_1', 'pool1'],
+                                    [mask], [mask], style_cache=cache)
+            assert model.styles[0].masks['conv1_1'].shape == mask.shape
+        assert cache.misses == 1 and cache.hits == 1
+        assert fake.sizes == [(48, 40)]
+
+
+class FakeTransfer(style_transfer.StyleTransfer):
+    """A StyleTransfer which only preprocesses the images at each scale, as
+    transfer_multiscale() does, without a worker pool or an optimizer."""
+    def start_pool(self):
+        self.pool = self.pool or SimpleNamespace(reset_arena=lambda: None)
+
+    def transfer_multiscale(self, content_images, style_images, *args, **kwargs):
+        for size in reversed(style_transfer.scale_sizes()):
+            content = style_transfer.resize_to_fit(content_images[0], size)
+            styles = [style_transfer.resize_to_fit(image, size) for image in style_images]
+            mask = np.ones(content.size[::-1], np.float32)
+            self.model.contents, self.model.styles = [], []
+            self.model.preprocess_images(self.pool, [content], styles, ['conv1_1'], ['pool1'],
+                                         [mask], [mask] * len(styles), style_cache=self.style_cache)
+            self.current_output = content
+
+
+def test_batch_reuses_style_grams_across_content_sizes(tmpdir, monkeypatch):
+    """Batch rows which share a style but not a content size compute its Gram matrices once per
+    scale."""
+    model = placeholder_model(tmpdir)
+    model.prepare_features_many = fake = FakeFeatures(model)
+    Image.new('RGB', (80, 60), (10, 200, 30)).save(str(tmpdir.join('style.png')))
+    Image.new('RGB', (64, 48)).save(str(tmpdir.join('content1.png')))
+    Image.new('RGB', (48, 64)).save(str(tmpdir.join('content2.png')))
+    manifest = tmpdir.join('manifest.jsonl')
+    manifest.write('\n'.join(json.dumps({
+        'content': str(tmpdir.join(content)), 'style': str(tmpdir.join('style.png')),
+        'output': str(tmpdir.join('out.png'))}) for content in ('content1.png', 'content2.png')))
+    monkeypatch.setattr(style_transfer, 'ARGS', make_parser().parse_args(
+        ['--batch', str(manifest), '--size', '64', '--min-size', '32']))
+    monkeypatch.setattr(style_transfer, 'StyleTransfer', FakeTransfer)
+    monkeypatch.setattr(style_transfer, 'save_output', lambda *args, **kwargs: None)
+    assert style_transfer.run_batch(model, str(manifest)) == 0
+    # The first row computes the style and content features at each scale, the second only the
+    # content features
+    assert len(fake.sizes) == 3 * len(style_transfer.scale_sizes())
+
+
+def test_lbfgs_history_one():
+    """L-BFGS with one curvature pair replaces it each step and still minimizes a quadratic; a
+    history below one is rejected."""
+    rng = np.random.RandomState(0)
+    target = np.float32(rng.uniform(-1, 1, (3, 8, 8)))
+    opt = LBFGSOptimizer(np.zeros_like(target), step_size=0.5, history=1)
+    for _ in range(30):
+        opt.update(lambda params: (np.sum((params - target)**2), 2 * (params - target)))
+        assert len(opt.pairs) <= 1
+    assert np.max(abs(opt.params - target)) < 1e-3
+    base = make_parser().parse_args(['content.png', 'style.png'])
+    assert parse_job_args(['--lbfgs-history', '1'], base).lbfgs_history == 1
+    for history in '0', '-1':
+        with pytest.raises(ValueError):
+            parse_job_args(['--lbfgs-history', history], base)
+
+
+def test_style_pack_settings_checked_up_front(tmpdir, monkeypatch, capsys):
+    """load_style_images() rejects a pack made with other settings or layers than the run's with
+    an error message, before any work is done."""
+    model = placeholder_model(tmpdir)
+    argv = ['content.png', 'style.png', '--size', '64', '--min-size', '32',
+            '--style-layers', 'conv1_1']
+    monkeypatch.setattr(style_transfer, 'ARGS', make_parser().parse_args(argv))
+    sizes = [style_transfer.resize_to_fit(Image.new('RGB', (80, 60)), size).size
+             for size in style_transfer.scale_sizes()]
+    grams = {'conv1_1': np.eye(4, dtype=np.float32)}
+    filename = str(tmpdir.join('style.pak'))
+    StylePack.write(filename, StylePack.header_for(model, (80, 60), ['conv1_1'], 512, 10),
+                    {size: grams for size in sizes})
+    assert isinstance(style_transfer.load_style_images(model, [filename])[0], StylePack)
+
+    for extra, message in (['--stream-style-grams'], '--stream-style-grams'), \
+            (['--tile-size', '256'], '--tile-size'), (['--style-layers', 'pool1'], 'pool1'):
+        monkeypatch.setattr(style_transfer, 'ARGS', make_parser().parse_args(argv + extra))
+        with pytest.raises(SystemExit):
+            style_transfer.load_style_images(model, [filename])
+        assert message in capsys.readouterr().err